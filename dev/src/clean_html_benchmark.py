@@ -0,0 +1,90 @@
+import argparse
+import difflib
+import re
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+from util.html_text import html_to_text
+
+#
+# Benchmark executable, compares the output and speed of the lxml based html_to_text with the
+# previous BeautifulSoup based clean_confluence_html on sample pages
+#
+
+
+def clean_html_bs4(html_content: str) -> str:
+    """Previous implementation of ConfluenceClient.clean_confluence_html"""
+    soup = BeautifulSoup(html_content, "html.parser")
+    for script_or_style in soup(["script", "style"]):
+        script_or_style.decompose()
+    text = soup.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    text = "\n".join(chunk for chunk in chunks if chunk)
+    text = re.sub(r"\s+", " ", text)
+
+    return text.strip()
+
+
+def synthetic_pages() -> dict[str, str]:
+    """Pages in Confluence storage format, used if no sample directory is given"""
+    paragraph = "<p>Lorem <strong>ipsum</strong> dolor sit amet, <a href='#'>consectetur</a> adipiscing elit.</p>"
+    row = "<tr><td>Key {i}</td><td><p>Value {i}</p></td><td>2024-01-{d:02}</td></tr>"
+    macro = (
+        '<ac:structured-macro ac:name="code"><ac:parameter ac:name="language">python</ac:parameter>'
+        "<ac:plain-text-body><![CDATA[for i in range(10):\n    print(i < 5)]]></ac:plain-text-body>"
+        "</ac:structured-macro>"
+    )
+    table = "<table><tbody>{}</tbody></table>"
+    return {
+        "small": paragraph * 10,
+        "macros": (paragraph + macro) * 200,
+        "table": table.format(
+            "".join(row.format(i=i, d=i % 28 + 1) for i in range(5_000))
+        ),
+        "large": (paragraph * 50 + macro + table.format(row.format(i=1, d=1))) * 200,
+    }
+
+
+def measure(function, content: str, repetitions: int) -> tuple[str, float]:
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        text = function(content)
+    return text, (time.perf_counter() - start) / repetitions * 1000
+
+
+def main(directory: str | None, repetitions: int):
+    if directory:
+        pages = {p.name: p.read_text() for p in sorted(Path(directory).glob("*.html"))}
+    else:
+        pages = synthetic_pages()
+
+    print(
+        f"{'page':<24}{'size':>10}{'bs4 ms':>10}{'lxml ms':>10}{'speedup':>9}{'chars':>8}"
+    )
+    for name, content in pages.items():
+        reference, reference_ms = measure(clean_html_bs4, content, repetitions)
+        text, text_ms = measure(html_to_text, content, repetitions)
+
+        # The new cleaner separates blocks and cells and skips macro parameters,
+        # compare the characters of both outputs without separators
+        similarity = difflib.SequenceMatcher(
+            None,
+            re.sub(r"[\s|]", "", reference),
+            re.sub(r"[\s|]", "", text),
+            autojunk=False,
+        ).quick_ratio()
+        print(
+            f"{name[:23]:<24}{len(content):>10}{reference_ms:>10.1f}{text_ms:>10.1f}"
+            f"{reference_ms / text_ms:>8.1f}x{similarity:>8.1%}"
+        )
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "directory", nargs="?", help="directory of *.html storage format pages"
+)
+parser.add_argument("--repetitions", type=int, default=3)
+arguments = parser.parse_args()
+main(arguments.directory, arguments.repetitions)
@@ -1,16 +1,19 @@
 import asyncio
+from os import environ
 
+import numpy as np
 import structlog
-from langchain.evaluation.embedding_distance import EmbeddingDistanceEvalChain
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.runnables import RunnableConfig
 from langgraph.prebuilt import ToolNode
 from prompts.confluence.page_summary import PageSummary
 from shared.configuration import ConfigSchema
 from util.agent_functions import run_llm
+from util.confluence_index import ConfluenceIndex, load_confluence_index
 from util.ConfluenceClient import ConfluenceClient, Page, QueryResult
-from util.embedding import embedding_distance
-from util.llm_operations import is_hallucination
+from util.embedding import rank_texts
+from util.llm_operations import are_hallucinations
+from util.tokens import remaining_budget, truncate
 
 #
 # Contains confluence_query, a tool to execute CQL queries
@@ -19,75 +22,164 @@ from util.llm_operations import is_hallucination
 log = structlog.get_logger(emitter="confluence_tool")
 
 
-async def download_embed_page(
+async def download_page(
     client: ConfluenceClient,
     query_result: QueryResult,
-    embedding_model,
-    embedding_chain: EmbeddingDistanceEvalChain,
-    question_embedding: list[float],
-) -> tuple[float, Page] | None:
-    """Download a page and calculate the distance of its embedding to the questions embedding"""
-
-    # Download page
+) -> Page | None:
+    """Download a page, returning None if it has no usable body"""
     page = await client.get_page(query_result=query_result)
     if not page or not page.body:
         log.warn("could not download page", title=query_result.title)
         return None
     log.info("retrieved page", title=page.title, web_url=page.web_ui)
 
-    min_distance = embedding_distance(
-        page.body,
-        embedding_model,
-        embedding_chain,
+    return page
+
+
+async def rank_pages(
+    pages: list[Page],
+    aembed_batch,
+    question_embedding: np.ndarray,
+    k: int,
+) -> list[tuple[float, Page]]:
+    """Return the k pages whose embeddings are closest to the questions embedding, closest first"""
+    ranked = await rank_texts(
+        [page.body for page in pages],
+        aembed_batch,
         question_embedding,
+        k,
+    )
+
+    return [(distance, pages[i]) for i, distance in ranked]
+
+
+async def live_ranking(
+    client: ConfluenceClient,
+    query: str,
+    aembed_batch,
+    question_embedding: np.ndarray,
+    k: int,
+) -> list[tuple[float, Page]]:
+    """Download all pages matching the query and rank them by embedding them"""
+    log.info("downloading pages", query=query)
+    # Bodies are part of the search results, pages are only downloaded separately if a body is missing
+    query_results = await client.cql_all(
+        query, expand="content.body.storage,content.version"
+    )
+    pages = await asyncio.gather(
+        *[download_page(client=client, query_result=r) for r in query_results]
+    )
+    pages = [p for p in pages if p]
+
+    log.info("ranking pages", query=query, nr_documents=len(pages))
+    return await rank_pages(
+        pages,
+        aembed_batch=aembed_batch,
+        question_embedding=question_embedding,
+        k=k,
     )
 
-    return (min_distance, page)
+
+async def index_ranking(
+    client: ConfluenceClient,
+    query: str,
+    index: ConfluenceIndex,
+    aembed_batch,
+    question_embedding: np.ndarray,
+    k: int,
+) -> list[tuple[float, Page]]:
+    """Rank the pages matching the query using the index, only downloading the top k.
+
+    Pages that are not indexed or changed since they were indexed are downloaded and embedded.
+    """
+    query_results = await client.cql_all(query, expand="content.version")
+    indexed = [
+        r
+        for r in query_results
+        if r.id in index.page_index
+        and index.pages[index.page_index[r.id]].version == r.version
+    ]
+    indexed_ids = {r.id for r in indexed}
+    missing = [r for r in query_results if r.id not in indexed_ids]
+
+    candidates = index.search(question_embedding, k, page_ids=list(indexed_ids))
+    log.info(
+        "ranked pages using index",
+        query=query,
+        nr_documents=len(query_results),
+        nr_missing=len(missing),
+    )
+
+    # Only the selected indexed pages are downloaded
+    pages = await asyncio.gather(
+        *[download_page(client=client, query_result=r) for r in missing],
+        *[download_page(client=client, query_result=r) for _, r in candidates],
+    )
+    missing_pages = [p for p in pages[: len(missing)] if p]
+    ranked = [(d, p) for (d, _), p in zip(candidates, pages[len(missing) :]) if p]
+    if missing_pages:
+        ranked.extend(
+            await rank_pages(missing_pages, aembed_batch, question_embedding, k)
+        )
+
+    return sorted(ranked, key=lambda x: x[0])[:k]
 
 
 async def summarize_page(
     page: Page, question: str, llm: BaseChatModel, config: RunnableConfig
-) -> Page | None:
+) -> tuple[Page, str] | None:
     """Use the page_summary prompt template to summarize a page"""
     configurable: ConfigSchema = config["configurable"]
     prompt = configurable["template_environment"].get_template(
         "confluence/page_summary.j2"
     )
-    response: PageSummary = await run_llm(
-        llm,
-        prompt,
-        {
-            "confluence_page": str(page.body),
-            "user_question": question,
-        },
-        PageSummary,
-    )
+    variables = {"confluence_page": "", "user_question": question}
+
+    # Cut pages that do not fit into the template's token budget
+    page_body = str(page.body)
+    if (budget := remaining_budget(prompt, variables)) is not None:
+        page_body = truncate(page_body, budget, prompt.name)
+    variables["confluence_page"] = page_body
+
+    response: PageSummary = await run_llm(llm, prompt, variables, PageSummary)
 
     if not response.summary:
         return None
 
-    body = response.summary
+    return page, response.summary
 
-    hallucination = await is_hallucination(page.body.replace("\n", " "), body, config)
-    if hallucination.hallucination:
-        log.warn(
-            "hallucination detected",
-            page=page.title,
-            claim=body,
-            observations=hallucination.observations,
-        )
-        return None
 
-    log.info(
-        "shortened page",
-        title=page.title,
-        web_url=page.web_ui,
-        original_length=len(page.body),
-        shortened_length=len(body),
+async def verify_summaries(
+    summaries: list[tuple[Page, str]], config: RunnableConfig
+) -> list[Page]:
+    """Check the summaries for hallucinations and replace the bodies of the pages with their valid summaries"""
+    hallucinations = await are_hallucinations(
+        [(page.body.replace("\n", " "), body) for page, body in summaries], config
     )
 
-    page.body = body
-    return page
+    pages = []
+    for (page, body), hallucination in zip(summaries, hallucinations):
+        if hallucination.hallucination:
+            log.warn(
+                "hallucination detected",
+                page=page.title,
+                claim=body,
+                observations=hallucination.observations,
+            )
+            continue
+
+        log.info(
+            "shortened page",
+            title=page.title,
+            web_url=page.web_ui,
+            original_length=len(page.body),
+            shortened_length=len(body),
+        )
+
+        page.body = body
+        pages.append(page)
+
+    return pages
 
 
 # @tool(parse_docstring=True)
@@ -108,32 +200,26 @@ async def confluence_query(query: str, config: RunnableConfig) -> list[Page]:
     question = configurable["user_question"]
 
     log.info("embedding question", query=query)
-    embedding_model = configurable["models"]["default/embed"]
-    question_embedding: list[float] = configurable["question_embedding"]
-    embedding_chain: EmbeddingDistanceEvalChain = configurable["embedding_chain"]
+    aembed_batch = configurable["models"]["default/aembed_batch"]
+    question_embedding: np.ndarray = configurable["question_embedding"]
 
-    log.info("downloading pages", query=query)
-    query_results = await client.cql_all(query)
-    log.info("ranking pages", query=query, nr_documents=len(query_results))
-    ranked_pages = [
-        download_embed_page(
-            client=client,
-            query_result=result,
-            embedding_model=embedding_model,
-            embedding_chain=embedding_chain,
-            question_embedding=question_embedding,
+    index = None
+    if environ.get("CONFLUENCE_RETRIEVAL", "live") == "index":
+        index = load_confluence_index()
+
+    if index:
+        ranked_pages = await index_ranking(
+            client, query, index, aembed_batch, question_embedding, k=8
+        )
+    else:
+        ranked_pages = await live_ranking(
+            client, query, aembed_batch, question_embedding, k=8
         )
-        for result in query_results
-    ]
-    ranked_pages = await asyncio.gather(*ranked_pages)
-    ranked_pages = [p for p in ranked_pages if p]
-    ranked_pages = sorted(ranked_pages, key=lambda x: x[0])
 
     log.info("ranked pages", pages=[r[1].title for r in ranked_pages])
-    ranked_pages = ranked_pages[:8]
 
     log.info("summarizing pages", query=query, nr_documents=len(ranked_pages))
-    pages = await asyncio.gather(
+    summaries = await asyncio.gather(
         *[
             summarize_page(
                 page=page,
@@ -144,7 +230,7 @@ async def confluence_query(query: str, config: RunnableConfig) -> list[Page]:
             for _, page in ranked_pages
         ]
     )
-    return [p for p in pages if p]
+    return await verify_summaries([s for s in summaries if s], config)
 
 
 tool_node = ToolNode([confluence_query])
@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+from datetime import timedelta
+from getpass import getpass
+from os import environ
+from zoneinfo import ZoneInfo
+
+import structlog
+from dotenv import load_dotenv
+from shared.models import model_setup
+from util.confluence_index import (
+    ConfluenceIndex,
+    build_confluence_index,
+    current_version,
+    update_confluence_index,
+)
+from util.confluence_sync import ConfluenceStore, ConfluenceSync, PageChange
+from util.ConfluenceClient import ConfluenceClient
+from util.log_format import setup_global_logging
+
+#
+# Offline executable, synchronizes the Confluence spaces in CONFLUENCE_SPACES into a local store and
+# updates the vector index used by the "index" retrieval mode of the Confluence tool
+#
+
+log = structlog.get_logger(emitter="confluence_indexer")
+
+
+async def main(watch: bool, reconcile: bool):
+    setup_global_logging()
+    load_dotenv(override=True)
+
+    confluence_token = environ.get("CONFLUENCE_API_KEY")
+    if not confluence_token:
+        confluence_token = getpass("Confluence token: ")
+
+    spaces = [s.strip() for s in environ["CONFLUENCE_SPACES"].split(",") if s.strip()]
+    index_path = environ.get("CONFLUENCE_INDEX_PATH", "./cache/confluence_index")
+    store_path = environ.get("CONFLUENCE_STORE_PATH", "./cache/confluence.sqlite")
+    interval = int(environ.get("CONFLUENCE_SYNC_INTERVAL", 300))
+    reconcile_every = int(environ.get("CONFLUENCE_SYNC_RECONCILE_EVERY", 12))
+
+    client = ConfluenceClient(
+        confluence_token,
+        max_pages_limit=int(environ.get("CONFLUENCE_INDEX_MAX_PAGES", 10_000)),
+    )
+    aembed_batch = model_setup()["default/aembed_batch"]
+    store = ConfluenceStore(store_path)
+    sync = ConfluenceSync(
+        client,
+        store,
+        spaces,
+        overlap=timedelta(minutes=int(environ.get("CONFLUENCE_SYNC_OVERLAP", 60))),
+        server_timezone=(
+            ZoneInfo(environ["CONFLUENCE_TIMEZONE"])
+            if environ.get("CONFLUENCE_TIMEZONE")
+            else None
+        ),
+    )
+
+    # The index is built from the store once, afterwards only changes are applied
+    directory = current_version(index_path)
+    index = ConfluenceIndex.load(directory) if directory else None
+    if not index:
+        index = await build_confluence_index(store.pages(), aembed_batch)
+        if index:
+            index.save(index_path)
+
+    async def update_index(changes: list[PageChange]):
+        nonlocal index
+        index = await update_confluence_index(index, changes, aembed_batch)
+        if index:
+            index.save(index_path)
+            print(f"Wrote index of {len(index.pages)} pages to {index_path}")
+
+    sync.subscribe(update_index)
+
+    run = 0
+    while True:
+        changes = await sync.sync(
+            reconcile=reconcile or (run > 0 and run % reconcile_every == 0)
+        )
+        print(f"Synchronized {', '.join(spaces)}: {len(changes)} changed pages")
+        if not watch:
+            break
+        run += 1
+        await asyncio.sleep(interval)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--watch",
+    action="store_true",
+    help="keep synchronizing every CONFLUENCE_SYNC_INTERVAL seconds",
+)
+parser.add_argument(
+    "--reconcile",
+    action="store_true",
+    help="list all pages to detect deleted pages (done every CONFLUENCE_SYNC_RECONCILE_EVERY runs with --watch)",
+)
+arguments = parser.parse_args()
+asyncio.run(main(arguments.watch, arguments.reconcile))
@@ -9,7 +9,7 @@ from util.environment import setup_config_state
 
 
 async def main():
-    config, state = setup_config_state()
+    config, state = await setup_config_state()
 
     print("-" * 80)
     print(confluence_graph.get_graph().draw_mermaid())
@@ -1,6 +1,9 @@
+import math
+
 import structlog
 from confluence import confluence_graph
 from jinja2 import Template
+from langchain_core.callbacks.manager import adispatch_custom_event
 from langchain_core.messages import SystemMessage
 from langchain_core.runnables.config import RunnableConfig
 from langchain_openai import ChatOpenAI
@@ -8,10 +11,13 @@ from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, START, StateGraph
 from prompts.main import ToolChoice, Tools, Validation
 from rocket import rocket_graph
+from shared.configuration import ConfigSchema
 from shared.main_output import ErrorOutput, SuccessOutput
 from shared.state import ConfluenceState, GraphState, RocketChatState
 from util.agent_functions import dispatch_log, run_llm, unpack_node
-from util.llm_operations import is_hallucination
+from util.embedding import rank_texts
+from util.llm_operations import verify_answer
+from util.tokens import count_tokens, pack, token_budget
 
 # General agent information:
 # There are two main nodes (thinking and action) that the state oscillates between.
@@ -57,6 +63,8 @@ async def aggregator(
     cs: ConfluenceState,
     question: str,
     templates: dict[str, Template],
+    aembed_batch,
+    configurable: ConfigSchema,
 ):
     """Generate reply to the user, given the retrieved information or failure to do so."""
     await dispatch_log(
@@ -66,15 +74,41 @@ async def aggregator(
     )
 
     pages = [page for pages in cs["confluence_pages"] for page in pages]
+    chats = state["rocket_chat_state"]["results"]
     prompt = templates["aggregate"].render(
-        user_question=question,
-        documents=pages,
-        replies=[],
-        chat_messages=state["rocket_chat_state"]["results"],
+        user_question=question, documents=pages, replies=[], chat_messages=chats
     )
-    output = await llm.ainvoke([SystemMessage(prompt)])
 
-    state.update(final_response=SuccessOutput(message=output.content))
+    # Keep the documents most relevant to the question that fit into the token budget
+    budget = token_budget(templates["aggregate"].name)
+    if budget is not None and (tokens := count_tokens(prompt)) > budget:
+        texts = [f"{p.title}\n{p.body}" for p in pages] + [s for _, s in chats]
+        costs = [count_tokens(t) for t in texts]
+        ranked = await rank_texts(
+            texts, aembed_batch, configurable["question_embedding"]
+        )
+        scores = [-math.inf] * len(texts)
+        for i, d in ranked:
+            scores[i] = -d
+
+        packed = pack(
+            costs,
+            budget - (tokens - sum(costs)),
+            templates["aggregate"].name,
+            scores,
+        )
+        prompt = templates["aggregate"].render(
+            user_question=question,
+            documents=[pages[i] for i in packed if i < len(pages)],
+            replies=[],
+            chat_messages=[chats[i - len(pages)] for i in packed if i >= len(pages)],
+        )
+    # The chunks are forwarded to the client as they are generated (see server.stream_graph)
+    message = ""
+    async for chunk in llm.astream([SystemMessage(prompt)]):
+        message += chunk.content
+
+    state.update(final_response=SuccessOutput(message=message))
     return state
 
 
@@ -107,12 +141,19 @@ async def final_validation(
             state.update(final_response=ErrorOutput(message="A fatal error occurred"))
         case SuccessOutput(message=message):
             # Check for hallucinations
-            documents = [d.body for pages in cs["confluence_pages"] for d in pages]
-            documents.extend(state["rocket_chat_state"]["results"])
-
-            hallucination = await is_hallucination(
-                documents, message, config, leniency=True
+            # Titles and URLs are part of the evidence, the answer cites them
+            documents = [
+                f"{d.title} ({d.web_ui}): {d.body}"
+                for pages in cs["confluence_pages"]
+                for d in pages
+            ]
+            documents.extend(
+                f"{room.name or ', '.join(room.usernames or [])} ({room.url}): {summary}"
+                for room, summary in state["rocket_chat_state"]["results"]
             )
+
+            hallucination = await verify_answer(documents, message, config)
+            await adispatch_custom_event("answer_verdict", hallucination.model_dump())
             if hallucination.hallucination:
                 log.warn(
                     "hallucination occurred",
@@ -12,7 +12,7 @@ from util.environment import setup_config_state
 
 
 async def main():
-    config, state = setup_config_state()
+    config, state = await setup_config_state()
 
     print("-" * 80)
     print(graph.get_graph().draw_mermaid())
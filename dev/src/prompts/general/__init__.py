@@ -1 +1,2 @@
 from prompts.general.is_hallucination import Hallucination
+from prompts.general.is_hallucination_batch import ClaimVerdict, Hallucinations
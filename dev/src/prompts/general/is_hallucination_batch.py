@@ -0,0 +1,15 @@
+from pydantic import BaseModel, Field
+
+
+class ClaimVerdict(BaseModel):
+    claim: int = Field(description="The number of the claim")
+    observations: str = Field(
+        description="Very concise observation of the input and what it means for your final decision - maximum 50 words"
+    )
+    hallucination: bool = Field(description="true if the claim does not hold")
+
+
+class Hallucinations(BaseModel):
+    verdicts: list[ClaimVerdict] = Field(
+        description="One verdict for every claim, in the order of the claims"
+    )
@@ -1,9 +1,11 @@
 import asyncio
+import math
 import re
+from os import environ
 
+import numpy as np
 import structlog
 from jinja2 import Template
-from langchain.evaluation.embedding_distance import EmbeddingDistanceEvalChain
 from langchain_core.runnables.config import RunnableConfig
 from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
@@ -13,8 +15,14 @@ from rocket.tool import rocket_chat_search
 from shared.configuration import ConfigSchema
 from shared.state import GraphState, RocketChatState
 from util.agent_functions import dispatch_log, run_llm, unpack_node
-from util.rocket_client import ChatRoom, RocketChatClient, RocketChatMessage
-from util.embedding import embedding_distance
+from util.rocket_client import (
+    ChatRoom,
+    RocketChatClient,
+    RocketChatMessage,
+    ThreadExcerpt,
+)
+from util.embedding import rank_texts
+from util.tokens import count_tokens, pack, remaining_budget
 
 # General agent information:
 # There are two main nodes (thinking and action) that the state oscillates between.
@@ -26,8 +34,8 @@ from util.embedding import embedding_distance
 log = structlog.get_logger(emitter="rocket_graph")
 
 
-async def update_channels(rs: RocketChatState, pattern: str):
-    """Limit the number of channels that are searched by the agent using a generated pattern."""
+async def update_channels(rs: RocketChatState, pattern: str) -> bool:
+    """Limit the number of channels that are searched by the agent using a generated pattern, returns whether the pattern matched."""
     channel_pattern = re.compile(pattern, re.IGNORECASE)
 
     channels = [r for r in rs["chat_rooms"] if r.room_type == "c"]
@@ -43,8 +51,29 @@ async def update_channels(rs: RocketChatState, pattern: str):
             n=len(rs["chat_rooms"]),
             rooms=rs["chat_rooms"],
         )
-    else:
-        log.info("pattern did not result in matches")
+        return True
+
+    log.info("pattern did not result in matches")
+    return False
+
+
+def room_text(room: ChatRoom) -> str:
+    """Describe a channel by its name and description"""
+    return " - ".join(t for t in [room.name, room.description] if t)
+
+
+async def rank_rooms(
+    rooms: list[ChatRoom],
+    question_embedding: np.ndarray,
+    aembed_batch,
+    n: int,
+) -> list[ChatRoom]:
+    """Return the n rooms whose descriptions are closest to the question, closest first"""
+    # The embeddings of unchanged rooms are served from the embedding cache
+    ranked = await rank_texts(
+        [room_text(r) for r in rooms], aembed_batch, question_embedding, n
+    )
+    return [rooms[i] for i, _ in ranked]
 
 
 @unpack_node(
@@ -58,7 +87,9 @@ async def build_search_pattern(
     state: GraphState,
     config: RunnableConfig,
     llm: ChatOpenAI,
+    aembed_batch,
     templates: dict[str, Template],
+    configurable: ConfigSchema,
     rc: RocketChatClient,
     rs: RocketChatState,
     question: str,
@@ -77,6 +108,7 @@ async def build_search_pattern(
             ChannelSelection,
         )
 
+        selected = False
         if not channel_selection.regular_expression:
             log.info("no pattern created, skipping")
         else:
@@ -85,7 +117,22 @@ async def build_search_pattern(
                 pattern=channel_selection.regular_expression,
                 identifiers=channel_selection.extracted_identifiers,
             )
-            await update_channels(rs, channel_selection.regular_expression)
+            selected = await update_channels(rs, channel_selection.regular_expression)
+
+        # Without a selection, only search the channels closest to the question, dms are always searched
+        max_rooms = int(environ.get("ROCKET_MAX_ROOMS", 20))
+        direct = [r for r in rs["chat_rooms"] if r.room_type == "d"]
+        channels = [r for r in rs["chat_rooms"] if r.room_type != "d"]
+        if not selected and 0 < max_rooms < len(channels):
+            rs["chat_rooms"] = direct + await rank_rooms(
+                channels,
+                configurable["question_embedding"],
+                aembed_batch,
+                max_rooms,
+            )
+            log.info(
+                "pre-ranked chat rooms", n=len(rs["chat_rooms"]), rooms=rs["chat_rooms"]
+            )
 
     # Create new regex search pattern
     regex_search: RegexSearch = await run_llm(
@@ -108,39 +155,89 @@ async def build_search_pattern(
     return state
 
 
-async def summarize_chat(llm, template, template_variables, room):
+def unit_tokens(unit: RocketChatMessage | list[RocketChatMessage]) -> int:
+    """Estimate the tokens of a message or thread as it is rendered in the chat table"""
+    messages = unit if isinstance(unit, list) else [unit]
+    return sum(
+        count_tokens(f"|{m.username}|{m.timestamp}|{m.message}|y|") for m in messages
+    )
+
+
+async def summarize_chat(llm, template, template_variables, room, scores=None):
+    # Pack the most relevant messages into the template's token budget
+    messages = template_variables["messages"]
+    budget = remaining_budget(template, {**template_variables, "messages": []})
+    if budget is not None:
+        packed = pack([unit_tokens(u) for u in messages], budget, template.name, scores)
+        messages = [messages[i] for i in packed]
+
     summary = await run_llm(
         llm,
         template,
-        template_variables,
+        {**template_variables, "messages": messages},
         SummarizeChat,
     )
     return room, summary
 
 
-async def rank_chat(
-    chat_room: ChatRoom,
-    messages: list[RocketChatMessage | list[RocketChatMessage]],
-    question_embedding: list[float],
-    embedding_chain: EmbeddingDistanceEvalChain,
-    embedding_model,
-) -> tuple[
-    float,
-    ChatRoom,
-    list[RocketChatMessage | list[RocketChatMessage]],
+def unit_text(unit: RocketChatMessage | list[RocketChatMessage]) -> str:
+    """The text of a single message or of all messages of a thread"""
+    if isinstance(unit, list):
+        return "\n".join(m.message for m in unit)
+    return unit.message
+
+
+async def rank_messages(
+    search_results: list[
+        tuple[ChatRoom, list[RocketChatMessage | list[RocketChatMessage]]]
+    ],
+    question_embedding: np.ndarray,
+    aembed_batch,
+    k_units: int,
+    k_rooms: int,
+) -> list[
+    tuple[
+        float,
+        ChatRoom,
+        list[RocketChatMessage | list[RocketChatMessage]],
+        list[float],
+    ]
 ]:
-    single_messages = [m.message for m in messages if type(m) is not list]
-    threads = [t for t in messages if type(t) is list]
-    threads = [m.message for t in threads for m in t]
-    text = ";".join(single_messages + threads)
-
-    d = embedding_distance(
-        text,
-        embedding_model,
-        embedding_chain,
-        question_embedding,
+    """Rank the messages and threads (units) of all chats together in one pass.
+
+    Returns the k_rooms chats containing the k_units closest units, closest first. Every chat
+    only contains its selected units in their original order (with their distances) and is
+    scored by its closest unit.
+    """
+    units = [
+        (r, j, unit)
+        for r, (_, messages) in enumerate(search_results)
+        for j, unit in enumerate(messages)
+    ]
+    ranked = await rank_texts(
+        [unit_text(u) for _, _, u in units], aembed_batch, question_embedding, k_units
     )
-    return (d, chat_room, messages)
+
+    # The ranking is ordered by distance, the first unit of a chat is its closest
+    distances: dict[int, float] = {}
+    selected: dict[int, list[tuple[int, float]]] = {}
+    for i, d in ranked:
+        if not math.isfinite(d):
+            continue
+        r, j, _ = units[i]
+        distances.setdefault(r, d)
+        selected.setdefault(r, []).append((j, d))
+
+    rooms = sorted(distances, key=distances.get)[:k_rooms]
+    return [
+        (
+            distances[r],
+            search_results[r][0],
+            [search_results[r][1][j] for j, _ in sorted(selected[r])],
+            [d for _, d in sorted(selected[r])],
+        )
+        for r in rooms
+    ]
 
 
 @unpack_node(
@@ -151,34 +248,37 @@ async def search(
     state: GraphState,
     config: RunnableConfig,
     llm: ChatOpenAI,
-    embedding_model,
+    aembed_batch,
     templates: dict[str, Template],
     configurable: ConfigSchema,
     rc: RocketChatClient,
     question: str,
 ):
     """Action state, executed the latest CQL query and stores the results in the graph's state."""
-    question_embedding: list[float] = configurable["question_embedding"]
-    embedding_chain: EmbeddingDistanceEvalChain = configurable["embedding_chain"]
+    question_embedding: np.ndarray = configurable["question_embedding"]
 
     try:
         if search_results := await rocket_chat_search(state, config):
-            # Rank chats using an embedding model
-            ranked_results = [
-                rank_chat(
-                    r[0],
-                    r[1],
-                    question_embedding,
-                    embedding_chain,
-                    embedding_model,
+            # Rank the messages and threads of all chats using an embedding model
+            ranked_results = await rank_messages(
+                search_results,
+                question_embedding,
+                aembed_batch,
+                k_units=int(environ.get("ROCKET_MAX_MESSAGES", 20)),
+                k_rooms=3,
+            )
+            ranked_results = [(s[1], s[2], s[3]) for s in ranked_results]
+
+            # Only grow the thread excerpts that are summarized
+            if grow_window := int(environ.get("ROCKET_THREAD_GROW_WINDOW", 0)):
+                await asyncio.gather(
+                    *[
+                        rc.grow_excerpt(unit, grow_window)
+                        for _, messages, _ in ranked_results
+                        for unit in messages
+                        if isinstance(unit, ThreadExcerpt) and unit.window < grow_window
+                    ]
                 )
-                for r in search_results
-            ]
-            ranked_results = await asyncio.gather(*ranked_results)
-            ranked_results = sorted(ranked_results, key=lambda x: x[0])
-            # Select the top 5 chats
-            ranked_results = ranked_results[:3]
-            ranked_results = [(s[1], s[2]) for s in ranked_results]
 
             log.info(
                 "ranked results",
@@ -198,8 +298,10 @@ async def search(
                         "user_request": question,
                     },
                     room,
+                    # Closer units are more relevant
+                    [-d for d in distances],
                 )
-                for room, messages in ranked_results
+                for room, messages, distances in ranked_results
             ]
             summaries: list[tuple[ChatRoom, SummarizeChat]] = await asyncio.gather(
                 *summaries
@@ -1,12 +1,70 @@
+import asyncio
+from os import environ
+
 import structlog
 from langchain_core.runnables.config import RunnableConfig
 from shared.configuration import ConfigSchema
 from shared.state import RocketChatState
-from util.rocket_client import ChatRoom, RocketChatMessage
+from util.rocket_client import (
+    ChatRoom,
+    RocketChatClient,
+    RocketChatMessage,
+    ThreadExcerpt,
+    expand_threads,
+)
+from util.rocket_sync import RocketStore, load_rocket_store
 
 log = structlog.get_logger(emitter="rocket_tool")
 
 
+async def local_search(
+    rc: RocketChatClient,
+    store: RocketStore,
+    terms: list[str],
+    search_pattern: str,
+    chats: list[ChatRoom],
+) -> list[tuple[ChatRoom, list[RocketChatMessage | list[RocketChatMessage]]]]:
+    """Search the synchronized rooms in the local store, rooms that were not synchronized are searched using the API"""
+    # SQLite is accessed in a worker thread to not block the event loop
+    synced = await asyncio.to_thread(store.synced_rooms, [c.room_id for c in chats])
+    results = await asyncio.to_thread(store.search, terms, list(synced))
+    threads = await asyncio.to_thread(
+        store.threads,
+        list({m.thread_id for r in results.values() for m in r if m.thread_id}),
+    )
+    if rc.thread_window:
+        # Only keep the messages around the matches, preceded by the thread's first message if it was not found
+        hits = [m for r in results.values() for m in r]
+        hit_ids = {m.message_id for m in hits}
+        roots = await asyncio.to_thread(
+            store.messages, [t for t in threads if t not in hit_ids]
+        )
+        threads = {
+            t: ThreadExcerpt(
+                t,
+                roots.get(t),
+                messages,
+                {m.message_id for m in hits if m.thread_id == t},
+                rc.thread_window,
+                complete=True,
+            )
+            for t, messages in threads.items()
+        }
+
+    chat_results = [
+        (c, expand_threads(results[c.room_id], threads))
+        for c in chats
+        if c.room_id in results
+    ]
+
+    live_chats = [c for c in chats if c.room_id not in synced]
+    log.info("searched local store", n_local=len(synced), n_live=len(live_chats))
+    if live_chats:
+        chat_results += await rc.search_text(pattern=search_pattern, chats=live_chats)
+
+    return chat_results
+
+
 async def rocket_chat_search(
     state: RocketChatState, config: RunnableConfig
 ) -> None | list[tuple[ChatRoom, list[RocketChatMessage | list[RocketChatMessage]]]]:
@@ -36,10 +94,19 @@ async def rocket_chat_search(
     search_pattern = "/(" + "|".join(new_terms) + ")/i"
     log.info("generated search pattern", search_pattern=search_pattern)
 
+    store = None
+    if environ.get("ROCKET_SEARCH_MODE", "live") == "local":
+        store = load_rocket_store()
+
     try:
-        chat_results = await rc.search_text(
-            pattern=search_pattern, chats=rs["chat_rooms"]
-        )
+        if store:
+            chat_results = await local_search(
+                rc, store, new_terms, search_pattern, rs["chat_rooms"]
+            )
+        else:
+            chat_results = await rc.search_text(
+                pattern=search_pattern, chats=rs["chat_rooms"]
+            )
         log.info("search done", results=chat_results)
 
         return chat_results
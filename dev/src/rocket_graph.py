@@ -9,7 +9,7 @@ from rocket import rocket_graph
 
 
 async def main():
-    config, state = setup_config_state()
+    config, state = await setup_config_state()
 
     print("-" * 80)
     print(rocket_graph.get_graph().draw_mermaid())
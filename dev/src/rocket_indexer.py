@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+from getpass import getpass
+from os import environ
+
+import structlog
+from dotenv import load_dotenv
+from util.log_format import setup_global_logging
+from util.rocket_client import RocketChatClient
+from util.rocket_sync import RocketStore, RocketSync
+
+#
+# Offline executable, synchronizes the histories of all rooms of a Rocket.Chat user into the
+# local store used by the "local" search mode of the Rocket.Chat tool
+#
+
+log = structlog.get_logger(emitter="rocket_indexer")
+
+
+async def main(watch: bool):
+    setup_global_logging()
+    load_dotenv(override=True)
+
+    rocket_token = environ.get("ROCKET_CHAT_TOKEN")
+    if not rocket_token:
+        rocket_token = getpass("Rocket token: ")
+    rocket_id = environ.get("ROCKET_CHAT_ID")
+    if not rocket_id:
+        rocket_id = getpass("Rocket Chat ID: ")
+
+    store_path = environ.get("ROCKET_STORE_PATH", "./cache/rocket.sqlite")
+    interval = int(environ.get("ROCKET_SYNC_INTERVAL", 300))
+
+    sync = RocketSync(
+        RocketChatClient(rocket_token, rocket_id),
+        RocketStore(store_path),
+        max_messages=int(environ.get("ROCKET_SYNC_MAX_MESSAGES", 1000)),
+    )
+
+    while True:
+        n = await sync.sync()
+        print(f"Synchronized {n} new messages into {store_path}")
+        if not watch:
+            break
+        await asyncio.sleep(interval)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--watch",
+    action="store_true",
+    help="keep synchronizing every ROCKET_SYNC_INTERVAL seconds",
+)
+arguments = parser.parse_args()
+asyncio.run(main(arguments.watch))
@@ -1,14 +1,20 @@
+import asyncio
 import json
+from os import environ
+from contextlib import asynccontextmanager
 
 import structlog
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
+from shared.models import aclose_openai_clients
 from shared.state import GraphState
 from main import graph
 from util.environment import setup_config_state
+from util.html_text import shutdown_process_pool
+from util.http_pool import ClientPool
 from fastapi.middleware.cors import CORSMiddleware
 
-# Provides a server that runs the graph and returns custom events + the last message that was generated
+# Provides a server that runs the graph and returns custom events, the tokens of the answer + the last message that was generated
 # fastapi dev src/server.py
 
 log = structlog.get_logger(emitter="server")
@@ -20,8 +26,9 @@ print("-" * 80)
 origins = ["http://localhost", "http://127.0.0.1:5174/", "http://127.0.0.1:8000/", "*"]
 
 
-async def stream_graph(query: str):
-    config, state = setup_config_state(query)
+async def stream_graph(query: str, client_pool: ClientPool):
+    config, state = await setup_config_state(query, client_pool)
+    stream_answer = environ.get("ANSWER_STREAMING", "true").lower() == "true"
     final_response = None
 
     try:
@@ -36,6 +43,15 @@ async def stream_graph(query: str):
 
                 m = json.dumps({"event": name, "data": data})
                 yield m + "\n"
+            elif (
+                stream_answer
+                and event["event"] == "on_chat_model_stream"
+                and event["metadata"].get("langgraph_node") == "aggregator"
+            ):
+                # Forward the tokens of the answer, the verdict of the hallucination check follows as answer_verdict
+                if token := event["data"]["chunk"].content:
+                    m = json.dumps({"event": "answer_token", "data": {"token": token}})
+                    yield m + "\n"
 
         final_state: GraphState = graph.get_state(config=config).values
         final_response = final_state["final_response"]
@@ -48,6 +64,11 @@ async def stream_graph(query: str):
             }
         )
         yield error_message + "\n"
+    finally:
+        # The pooled HTTP clients of this run can be evicted again
+        configurable = config["configurable"]
+        client_pool.release(configurable["__confluence_client"].client)
+        client_pool.release(configurable["__rocket_client"].client)
 
     if final_response:
         m = json.dumps({"event": "final_message", "data": final_response.model_dump()})
@@ -64,7 +85,22 @@ async def stream_graph(query: str):
         yield error_message + "\n"
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # HTTP clients (and their connections) are shared by all requests of the same user
+    client_pool = ClientPool.from_environment()
+    eviction = asyncio.create_task(client_pool.run_eviction())
+    app.state.client_pool = client_pool
+
+    yield
+
+    eviction.cancel()
+    await client_pool.aclose()
+    await aclose_openai_clients()
+    await asyncio.to_thread(shutdown_process_pool)
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -75,5 +111,8 @@ app.add_middleware(
 
 
 @app.get("/streaming/{query}")
-async def main(query: str):
-    return StreamingResponse(stream_graph(query), media_type="text/event-stream")
+async def main(query: str, request: Request):
+    return StreamingResponse(
+        stream_graph(query, request.app.state.client_pool),
+        media_type="text/event-stream",
+    )
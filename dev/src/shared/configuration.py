@@ -3,14 +3,17 @@ from os import environ
 from typing import TypedDict
 from uuid import uuid1
 
+import numpy as np
 import structlog
 from jinja2 import Environment, FileSystemLoader
-from langchain.evaluation import EmbeddingDistance
-from langchain.evaluation.embedding_distance import EmbeddingDistanceEvalChain
 from langchain_core.language_models.chat_models import BaseChatModel
 from shared.models import model_setup
 from util.ConfluenceClient import ConfluenceClient
+from util.http_pool import ClientPool
+from util.page_cache import page_cache
+from util.rocket_cache import rocket_cache
 from util.rocket_client import RocketChatClient
+from util.scoring import normalize
 
 #
 # Contains global runtime configuration
@@ -29,16 +32,16 @@ class ConfigSchema(TypedDict):
     user_question: str
     thread_id: str
     template_environment: Environment
-    question_embedding: list[float]
-    embedding_chain: EmbeddingDistanceEvalChain
+    question_embedding: np.ndarray
     __rocket_client: RocketChatClient
 
 
-def initialize_configuration(
+async def initialize_configuration(
     confluence_token: str,
     user_question: str,
     rocket_token: str,
     rocket_id: str,
+    client_pool: ClientPool | None = None,
 ) -> ConfigSchema:
     environment = Environment(
         loader=FileSystemLoader("src/prompts/"),
@@ -63,19 +66,22 @@ def initialize_configuration(
 
     models = model_setup()
 
-    embedding_model = models["default/embed"]
-    question_embedding: list[float] = embedding_model(f"query: {user_question}")
-    embedding_chain = EmbeddingDistanceEvalChain(
-        distance_metric=EmbeddingDistance.COSINE
-    )
+    aembed_batch = models["default/aembed_batch"]
+    question_embedding = normalize((await aembed_batch([f"query: {user_question}"]))[0])
 
     return {
         "models": models,
-        "__confluence_client": ConfluenceClient(confluence_token),
+        "__confluence_client": ConfluenceClient(
+            confluence_token, page_cache=page_cache(), client_pool=client_pool
+        ),
         "user_question": user_question,
         "thread_id": uuid1(),
         "question_embedding": question_embedding,
-        "embedding_chain": embedding_chain,
         "template_environment": environment,
-        "__rocket_client": RocketChatClient(rocket_token, rocket_id),
+        "__rocket_client": RocketChatClient(
+            rocket_token,
+            rocket_id,
+            client_pool=client_pool,
+            rocket_cache=rocket_cache(),
+        ),
     }
@@ -1,9 +1,10 @@
+import asyncio
 import os
 
 import structlog
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_openai import ChatOpenAI
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 #
 # Provides model_setup that handles the LLM and embedding-model setup
@@ -11,6 +12,24 @@ from openai import OpenAI
 
 log = structlog.get_logger(emitter="models")
 
+# OpenAI clients keyed by their base URL, shared by all requests of the process
+_clients: dict[str, AsyncOpenAI] = {}
+
+
+def openai_client(root_url: str) -> AsyncOpenAI:
+    """Return the process-wide OpenAI client of root_url"""
+    if root_url not in _clients:
+        log.info("creating openai client", root_url=root_url)
+        _clients[root_url] = AsyncOpenAI(base_url=root_url)
+    return _clients[root_url]
+
+
+async def aclose_openai_clients():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.close()
+
 
 def model_setup() -> dict[str, BaseChatModel]:
     """Provide handlers to available models"""
@@ -35,7 +54,7 @@ def model_setup() -> dict[str, BaseChatModel]:
     models[model_path] = ChatOpenAI(
         model=model_name,
         temperature=0.1,
-        max_tokens=1500,  # per request
+        max_tokens=int(os.environ.get("MODEL_MAX_TOKENS", 1500)),  # per request
         timeout=60.0,  # seconds
         max_retries=2,
         base_url=root_url,
@@ -56,19 +75,33 @@ def model_setup() -> dict[str, BaseChatModel]:
         root_url=root_url,
         key=model_path,
     )
-    open_ai = OpenAI(base_url=root_url)
+    async_open_ai = openai_client(root_url)
+    batch_size = int(os.environ.get("EMBEDDING_BATCH_SIZE", 64))
+    # Limits the number of embedding requests that are in flight at the same time
+    max_concurrency = int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", 4))
+    semaphore = asyncio.Semaphore(max_concurrency)
 
-    def embed(text: str) -> list[float]:
-        return (
-            open_ai.embeddings.create(
-                input=text,
+    async def embed_batch_request(texts: list[str]) -> list[list[float]]:
+        async with semaphore:
+            response = await async_open_ai.embeddings.create(
+                input=texts,
                 model=default_embedding,
             )
-            .data[0]
-            .embedding
+        # The API does not guarantee that the order of the data matches the input
+        data = sorted(response.data, key=lambda d: d.index)
+        return [d.embedding for d in data]
+
+    async def aembed_batch(texts: list[str]) -> list[list[float]]:
+        """Embed many texts using as few requests as possible (at most batch_size texts per request)"""
+        batches = await asyncio.gather(
+            *[
+                embed_batch_request(texts[s : s + batch_size])
+                for s in range(0, len(texts), batch_size)
+            ]
         )
+        return [e for batch in batches for e in batch]
 
     # This not nice, but langchain_openai.OpenAIEmbedding is broken ...
-    models["default/embed"] = embed
+    models["default/aembed_batch"] = aembed_batch
 
     return models
@@ -1,10 +1,14 @@
-import re
-from dataclasses import dataclass
+import asyncio
+import time
+from dataclasses import dataclass, field
 from os import environ
 
 import structlog
-from bs4 import BeautifulSoup
 from httpx import AsyncClient
+from util.http_pool import ClientPool
+from util.scheduler import scheduled_get
+from util.html_text import ahtml_to_text, html_to_text
+from util.page_cache import CachedPage, PageCache
 
 log = structlog.get_logger(emitter="confluence_client")
 
@@ -18,6 +22,11 @@ class QueryResult:
     id: str
     web_ui: str
     self_url: str
+    version: int | None = None
+    # ISO timestamp of the version, only set if the version was expanded in the search
+    modified: str | None = None
+    # Storage format body, only set if it was expanded in the search
+    body: str | None = field(default=None, repr=False)
 
 
 @dataclass
@@ -36,19 +45,25 @@ class ConfluenceClient:
         token,
         max_pages_limit: int = 100,
         step_size: int = 25,
+        max_concurrency: int = 4,
+        page_cache: PageCache | None = None,
+        client_pool: ClientPool | None = None,
     ):
         self.base_url = environ["CONFLUENCE_URL"]
         headers = {"Accept": "application/json", "Authorization": f"Bearer {token}"}
-        self.client = AsyncClient(headers=headers)
+        if client_pool:
+            self.client = client_pool.get(self.base_url, headers)
+        else:
+            self.client = AsyncClient(headers=headers)
 
         self.max_pages_limit = max_pages_limit
         self.step_size = step_size
+        self.max_concurrency = max_concurrency
+        self.page_cache = page_cache
 
     async def get_page(self, query_result: QueryResult) -> Page | None:
         try:
-            result = await self.content_body(query_result.self_url)
-            body = result["body"]["storage"]["value"]
-            body = self.clean_confluence_html(body)
+            body = await self.page_body(query_result)
 
             return Page(
                 body=body,
@@ -60,21 +75,76 @@ class ConfluenceClient:
 
         return None
 
-    async def cql_all(self, cql: str) -> list[QueryResult]:
-        n: int = (await self.cql(cql=cql, start=0, limit=0))["totalSize"]
+    async def page_body(self, query_result: QueryResult) -> str:
+        """Return the cleaned body of a page, only downloading it if it is not cached or changed"""
+        cached = None
+        if self.page_cache:
+            # SQLite is accessed in a worker thread to not block the event loop
+            cached = await asyncio.to_thread(self.page_cache.get, query_result.id)
+            if cached and self.page_cache.is_fresh(cached, query_result.version):
+                self.page_cache.hits += 1
+                return cached.body
+
+        etag = None
+        if query_result.body is not None:
+            html = query_result.body
+            version = query_result.version
+        else:
+            # The body was not part of the search results, download it
+            result, etag = await self.content_body(
+                query_result.self_url, etag=cached.etag if cached else None
+            )
+            if result is None:
+                # Not modified since the cached version was downloaded
+                self.page_cache.revalidations += 1
+                cached.stored = time.time()
+                await asyncio.to_thread(self.page_cache.put, cached)
+                return cached.body
+            html = result["body"]["storage"]["value"]
+            version = result.get("version", {}).get("number")
+
+        body = await ahtml_to_text(html)
+        if self.page_cache:
+            self.page_cache.misses += 1
+            await asyncio.to_thread(
+                self.page_cache.put,
+                CachedPage(query_result.id, version, etag, body, time.time()),
+            )
+            log.info(
+                "page cache miss", title=query_result.title, **self.page_cache.stats()
+            )
+
+        return body
+
+    async def cql_all(self, cql: str, expand: str | None = None) -> list[QueryResult]:
+        # The first page also tells us the total number of results
+        first = await self.cql(cql=cql, start=0, limit=self.step_size, expand=expand)
+        n: int = first["totalSize"]
         log.info("number of pages for element determined", cql=cql, n=n)
 
-        # Retrieve data form API
-        start = 0
-        results: list[dict] = []
-        while start < n and start < self.max_pages_limit:
-            result = await self.cql(
-                cql=cql,
-                start=start,
-                limit=self.step_size,
-            )
-            results.extend(result["results"])
-            start += self.step_size
+        # All remaining offsets are known, retrieve them concurrently
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch(start: int) -> list[dict]:
+            async with semaphore:
+                result = await self.cql(
+                    cql=cql,
+                    start=start,
+                    limit=self.step_size,
+                    expand=expand,
+                )
+                return result["results"]
+
+        remaining = await asyncio.gather(
+            *[
+                fetch(start)
+                for start in range(
+                    self.step_size, min(n, self.max_pages_limit), self.step_size
+                )
+            ]
+        )
+        # gather keeps the order of the offsets
+        results: list[dict] = first["results"] + [r for rs in remaining for r in rs]
 
         # Prase API output
         pages: list[QueryResult] = []
@@ -90,42 +160,51 @@ class ConfluenceClient:
             url = result["content"]["_links"]["webui"]
             self_url = result["content"]["_links"]["self"]
             content_id = result["content"]["id"]
+            version = result["content"].get("version", {}).get("number")
+            modified = result["content"].get("version", {}).get("when")
+            body = result["content"].get("body", {}).get("storage", {}).get("value")
 
             return QueryResult(
                 title=title,
                 id=content_id,
                 web_ui=f"{self.base_url}{url}",
                 self_url=self_url,
+                version=version,
+                modified=modified,
+                body=body,
             )
         except:
             log.exception("could not parse query result", result=result)
         return None
 
     def clean_confluence_html(self, html_content):
-        soup = BeautifulSoup(html_content, "html.parser")
-        for script_or_style in soup(["script", "style"]):
-            script_or_style.decompose()
-        text = soup.get_text()
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = "\n".join(chunk for chunk in chunks if chunk)
-        text = re.sub(r"\s+", " ", text)
-
-        return text.strip()
-
-    async def content_body(self, self_url: str, expand="body.storage") -> dict:
+        return html_to_text(html_content)
+
+    async def content_body(
+        self, self_url: str, expand="body.storage,version", etag: str | None = None
+    ) -> tuple[dict | None, str | None]:
+        """Return the content and its ETag, the content is None if it was not modified since etag"""
         params = {"expand": expand}
+        headers = {"If-None-Match": etag} if etag else {}
 
-        response = await self.client.get(self_url, params=params)
+        response = await scheduled_get(
+            self.client, self_url, params=params, headers=headers
+        )
+        if response.status_code == 304:
+            return None, etag
         response.raise_for_status()
 
-        return response.json()
+        return response.json(), response.headers.get("ETag")
 
-    async def cql(self, cql: str, start: int, limit: int) -> dict:
+    async def cql(
+        self, cql: str, start: int, limit: int, expand: str | None = None
+    ) -> dict:
         params = {"cql": cql, "start": start, "limit": limit}
+        if expand:
+            params["expand"] = expand
         url = f"{self.base_url}/rest/api/search"
 
-        response = await self.client.get(url, params=params)
+        response = await scheduled_get(self.client, url, params=params)
         response.raise_for_status()
 
         return response.json()
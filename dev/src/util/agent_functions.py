@@ -8,6 +8,8 @@ from shared.configuration import ConfigSchema
 from langchain_core.callbacks.manager import adispatch_custom_event
 import inspect
 from langchain_core.messages import HumanMessage, SystemMessage
+from util.llm_cache import cached_invoke, is_cacheable
+from util.tokens import count_tokens, token_budget
 
 log = structlog.get_logger(emitter="agent_functions")
 
@@ -31,7 +33,7 @@ def unpack_node(log_message: str, template_paths: dict[str, str]):
             extracted = {
                 "configurable": configurable,
                 "llm": configurable["models"]["default/llm"],
-                "embedding_model": configurable["models"]["default/embed"],
+                "aembed_batch": configurable["models"]["default/aembed_batch"],
                 "question": configurable["user_question"],
                 "template_environment": template_environment,
                 "templates": templates,
@@ -57,24 +59,39 @@ async def run_llm(
     template_variables: dict,
     structure,
 ):
-    """Render a template, construct an LLM with structured output and invoke the LLM"""
+    """Render a template, construct an LLM with structured output and invoke the LLM (identical requests are cached)"""
     prompt = template.render(template_variables)
+    cache = is_cacheable(template.environment, template.name)
+
+    budget = token_budget(template.name)
+    if budget is not None and (tokens := count_tokens(prompt)) > budget:
+        log.warn(
+            "prompt exceeds token budget",
+            template=template.name,
+            tokens=tokens,
+            budget=budget,
+        )
 
     fail_counter = 0
     while True:
         try:
-            structured_llm = llm.with_structured_output(structure)
             if fail_counter > 0:
-                return await structured_llm.ainvoke(
+                return await cached_invoke(
+                    llm,
+                    structure,
                     [
                         SystemMessage(
                             content="It is important to conserve resources, keep your reply as short as possible."
                         ),
                         HumanMessage(content=prompt),
-                    ]
+                    ],
+                    template.name,
+                    cache,
                 )
             else:
-                return await structured_llm.ainvoke([prompt])
+                return await cached_invoke(
+                    llm, structure, [prompt], template.name, cache
+                )
         except LengthFinishReasonError as e:
             log.exception(
                 "LLM generated too many tokens",
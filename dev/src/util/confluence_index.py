@@ -0,0 +1,226 @@
+import json
+import os
+import shutil
+import time
+from dataclasses import asdict
+
+import numpy as np
+import structlog
+from util.confluence_sync import PageChange
+from util.ConfluenceClient import QueryResult
+from util.embedding import embed_chunks
+from util.scoring import top_k
+
+#
+# Persistent vector index of Confluence pages (memory-mapped chunk embeddings)
+#
+
+log = structlog.get_logger(emitter="confluence_index")
+
+
+class ConfluenceIndex:
+    """Index of chunk embeddings of Confluence pages.
+
+    The chunks of every page are stored contiguously in a memory-mapped float32 matrix, a
+    search scores all chunks of the given pages exactly.
+    """
+
+    def __init__(
+        self, pages: list[QueryResult], vectors: np.ndarray, owners: np.ndarray
+    ):
+        self.pages = pages
+        self.vectors = vectors
+        self.owners = owners
+
+        self.page_offsets = np.searchsorted(owners, np.arange(len(pages) + 1))
+        self.page_index = {p.id: i for i, p in enumerate(pages)}
+
+    @classmethod
+    def build(
+        cls,
+        pages: list[QueryResult],
+        vectors: np.ndarray,
+        owners: np.ndarray,
+    ) -> "ConfluenceIndex":
+        """Build an index from normalized chunk embeddings, owners are the page index of each chunk"""
+        # Keep the chunks of each page next to each other
+        order = np.argsort(owners, kind="stable")
+        vectors = np.ascontiguousarray(vectors[order], dtype=np.float32)
+        owners = owners[order]
+        log.info("built index", n_pages=len(pages), n_chunks=len(vectors))
+
+        return cls(pages, vectors, owners)
+
+    def save(self, path: str):
+        """Write the index into a new version directory and atomically switch CURRENT to it.
+
+        Loaded indexes keep memory-mapping the files of their version, the files of replaced
+        versions are unlinked but never rewritten.
+        """
+        version = str(time.time_ns())
+        directory = os.path.join(path, version)
+        os.makedirs(directory)
+        np.save(os.path.join(directory, "vectors.npy"), self.vectors)
+        np.save(os.path.join(directory, "owners.npy"), self.owners)
+        with open(os.path.join(directory, "pages.json"), "w") as f:
+            json.dump([asdict(p) | {"body": None} for p in self.pages], f)
+
+        current = os.path.join(path, "CURRENT")
+        with open(f"{current}.tmp", "w") as f:
+            f.write(version)
+        os.replace(f"{current}.tmp", current)
+
+        for entry in os.listdir(path):
+            if entry != version and entry.isdigit():
+                shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+        log.info("saved index", path=directory)
+
+    @classmethod
+    def load(cls, directory: str) -> "ConfluenceIndex":
+        """Load the index files of a version directory"""
+        with open(os.path.join(directory, "pages.json")) as f:
+            pages = [QueryResult(**p) for p in json.load(f)]
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        owners = np.load(os.path.join(directory, "owners.npy"))
+
+        return cls(pages, vectors, owners)
+
+    def rows(self, pages: list[int]) -> np.ndarray:
+        """The rows of the chunks of the given pages"""
+        if not pages:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate(
+            [np.arange(self.page_offsets[p], self.page_offsets[p + 1]) for p in pages]
+        )
+
+    def search(
+        self, question_embedding: np.ndarray, k: int, page_ids: list[str]
+    ) -> list[tuple[float, QueryResult]]:
+        """Return the k pages of page_ids closest to question_embedding, closest first"""
+        rows = self.rows([self.page_index[i] for i in page_ids if i in self.page_index])
+        if not len(rows):
+            return []
+
+        indices, distances = top_k(
+            question_embedding,
+            self.vectors[rows],
+            self.owners[rows],
+            len(self.pages),
+            k,
+        )
+        return [(float(d), self.pages[i]) for i, d in zip(indices, distances)]
+
+
+async def embed_pages(
+    pages: list[tuple[QueryResult, str]], aembed_batch, batch_size: int = 50
+) -> tuple[list[QueryResult], np.ndarray | None, np.ndarray | None]:
+    """Embed the bodies of pages in batches, returns the embedded pages, chunk embeddings and owners"""
+    results: list[QueryResult] = []
+    vectors: list[np.ndarray] = []
+    owners: list[np.ndarray] = []
+    for s in range(0, len(pages), batch_size):
+        batch = [(r, body) for r, body in pages[s : s + batch_size] if body]
+        batch_vectors, batch_owners = await embed_chunks(
+            [body for _, body in batch], aembed_batch
+        )
+        if len(batch_vectors):
+            vectors.append(batch_vectors)
+            owners.append(batch_owners + len(results))
+        results.extend(r for r, _ in batch)
+
+    if not vectors:
+        return results, None, None
+    return results, np.vstack(vectors), np.concatenate(owners)
+
+
+async def build_confluence_index(
+    pages: list[tuple[QueryResult, str]],
+    aembed_batch,
+    batch_size: int = 50,
+) -> ConfluenceIndex | None:
+    """Embed the bodies of pages in batches and build an index, returns None if there is nothing to index.
+
+    Embeddings are cached by content, only pages whose body changed since the last build are embedded again.
+    """
+    results, vectors, owners = await embed_pages(pages, aembed_batch, batch_size)
+    if vectors is None:
+        return None
+
+    return ConfluenceIndex.build(results, vectors, owners)
+
+
+async def update_confluence_index(
+    index: ConfluenceIndex | None,
+    changes: list[PageChange],
+    aembed_batch,
+    batch_size: int = 50,
+) -> ConfluenceIndex | None:
+    """Apply synchronized changes to an index, only the changed pages are embedded.
+
+    The chunks of updated and deleted pages are dropped, updated pages are appended.
+    Returns None if there is nothing to index.
+    """
+    changed = {c.page_id for c in changes}
+    pages: list[QueryResult] = []
+    vectors: list[np.ndarray] = []
+    owners: list[np.ndarray] = []
+    if index:
+        kept = [i for i, p in enumerate(index.pages) if p.id not in changed]
+        rows = index.rows(kept)
+        # Renumber the owners of the kept chunks
+        renumbered = np.full(len(index.pages), -1, dtype=np.intp)
+        renumbered[kept] = np.arange(len(kept))
+        pages = [index.pages[i] for i in kept]
+        vectors.append(np.asarray(index.vectors[rows]))
+        owners.append(renumbered[index.owners[rows]])
+
+    results, new_vectors, new_owners = await embed_pages(
+        [(c.result, c.body) for c in changes if c.kind == "updated"],
+        aembed_batch,
+        batch_size,
+    )
+    if new_vectors is not None:
+        vectors.append(new_vectors)
+        owners.append(new_owners + len(pages))
+    pages.extend(results)
+
+    if not pages or not sum(len(v) for v in vectors):
+        return None
+    log.info(
+        "updated index",
+        n_changed=len(changed),
+        n_embedded=len(results),
+        n_kept=len(pages) - len(results),
+    )
+
+    return ConfluenceIndex.build(pages, np.vstack(vectors), np.concatenate(owners))
+
+
+_loaded: tuple[str, ConfluenceIndex] | None = None
+
+
+def current_version(path: str) -> str | None:
+    """The version directory of the index at path that CURRENT points to"""
+    try:
+        with open(os.path.join(path, "CURRENT")) as f:
+            return os.path.join(path, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def load_confluence_index() -> ConfluenceIndex | None:
+    """Load the index at CONFLUENCE_INDEX_PATH, it is reloaded once a new version was saved"""
+    global _loaded
+    path = os.environ.get("CONFLUENCE_INDEX_PATH", "./cache/confluence_index")
+    directory = current_version(path)
+    if not directory:
+        log.warn("no confluence index found", path=path)
+        return None
+
+    if not _loaded or _loaded[0] != directory:
+        _loaded = (directory, ConfluenceIndex.load(directory))
+        log.info(
+            "loaded confluence index", path=directory, n_pages=len(_loaded[1].pages)
+        )
+
+    return _loaded[1]
@@ -0,0 +1,213 @@
+import asyncio
+import inspect
+import os
+import sqlite3
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import Awaitable, Callable
+
+import structlog
+from util.ConfluenceClient import ConfluenceClient, QueryResult
+
+#
+# Incremental synchronization of Confluence spaces into a local store
+#
+
+log = structlog.get_logger(emitter="confluence_sync")
+
+
+@dataclass
+class PageChange:
+    """
+    Represents a change of a Confluence page that was detected by a synchronization run.
+
+    :param kind: Either "updated" (created or new version) or "deleted".
+    :param page_id: The content id of the page.
+    :param result: The page's metadata, None if the page was deleted.
+    :param body: The cleaned body of the page, None if the page was deleted.
+    """
+
+    kind: str
+    page_id: str
+    result: QueryResult | None
+    body: str | None
+
+
+def space_cql(spaces: list[str]) -> str:
+    return "type = page AND space in ({})".format(", ".join(f'"{s}"' for s in spaces))
+
+
+class ConfluenceStore:
+    """SQLite store of the cleaned bodies and version numbers of synchronized pages"""
+
+    def __init__(self, path: str):
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                web_ui TEXT NOT NULL,
+                self_url TEXT NOT NULL,
+                version INTEGER,
+                body TEXT NOT NULL
+            )""")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.connection.commit()
+
+    def watermark(self) -> datetime | None:
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'watermark'"
+        ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def set_watermark(self, watermark: datetime):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('watermark', ?)",
+            [watermark.isoformat()],
+        )
+        self.connection.commit()
+
+    def versions(self) -> dict[str, int | None]:
+        return dict(self.connection.execute("SELECT id, version FROM pages"))
+
+    def pages(self) -> list[tuple[QueryResult, str]]:
+        rows = self.connection.execute(
+            "SELECT id, title, web_ui, self_url, version, body FROM pages ORDER BY id"
+        )
+        return [
+            (
+                QueryResult(
+                    id=i, title=title, web_ui=web_ui, self_url=self_url, version=version
+                ),
+                body,
+            )
+            for i, title, web_ui, self_url, version, body in rows
+        ]
+
+    def upsert(self, result: QueryResult, body: str):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pages VALUES (:id, :title, :web_ui, :self_url, :version, :body)",
+            {**asdict(result), "body": body},
+        )
+        self.connection.commit()
+
+    def delete(self, page_ids: list[str]):
+        self.connection.executemany(
+            "DELETE FROM pages WHERE id = ?", [(i,) for i in page_ids]
+        )
+        self.connection.commit()
+
+
+class ConfluenceSync:
+    """Synchronizes the pages of Confluence spaces into a ConfluenceStore.
+
+    Only pages modified since the last run (the watermark) are listed and only pages whose
+    version changed are downloaded. Subscribers are notified of all updated and deleted pages.
+    """
+
+    def __init__(
+        self,
+        client: ConfluenceClient,
+        store: ConfluenceStore,
+        spaces: list[str],
+        overlap: timedelta = timedelta(minutes=60),
+        server_timezone: tzinfo | None = None,
+    ):
+        self.client = client
+        self.store = store
+        self.spaces = spaces
+        # CQL dates only have minute precision, the overlap makes sure that no change is missed.
+        # Re-listed pages are skipped by version.
+        self.overlap = overlap
+        # CQL dates are interpreted in the server's timezone, if it is unknown the overlap is
+        # extended by the largest offset west of UTC
+        self.server_timezone = server_timezone
+        self.subscribers: list[Callable[[list[PageChange]], Awaitable[None] | None]] = (
+            []
+        )
+
+    def subscribe(
+        self, subscriber: Callable[[list[PageChange]], Awaitable[None] | None]
+    ):
+        """Register a (async) function that is called with the changes of every synchronization run"""
+        self.subscribers.append(subscriber)
+
+    async def sync(self, reconcile: bool = False) -> list[PageChange]:
+        """Fetch changed pages, store them and notify subscribers.
+
+        :param reconcile: List all pages of the spaces to detect deleted pages (CQL does not return deleted pages)
+        """
+        started = datetime.now(timezone.utc)
+        watermark = self.store.watermark()
+        cql = space_cql(self.spaces)
+        if watermark and not reconcile:
+            since = watermark - self.overlap
+            if self.server_timezone:
+                since = since.astimezone(self.server_timezone)
+            else:
+                since -= timedelta(hours=12)
+            cql = f'{cql} AND lastModified > "{since.strftime(r"%Y/%m/%d %H:%M")}"'
+        # A truncated listing contains the oldest changes, the next run continues after them
+        cql = f"{cql} ORDER BY lastmodified ASC"
+        log.info("synchronizing", cql=cql, watermark=watermark, reconcile=reconcile)
+
+        results = await self.client.cql_all(cql, expand="content.version")
+        versions = self.store.versions()
+        changed = [
+            r for r in results if r.id not in versions or versions[r.id] != r.version
+        ]
+
+        changes: list[PageChange] = []
+        failed: list[str] = []
+        pages = await asyncio.gather(*[self.client.get_page(r) for r in changed])
+        for result, page in zip(changed, pages):
+            if not page:
+                failed.append(result.id)
+                continue
+            self.store.upsert(result, page.body)
+            changes.append(PageChange("updated", result.id, result, page.body))
+
+        truncated = len(results) >= self.client.max_pages_limit
+        if reconcile and truncated:
+            # The listing was truncated, missing pages are not necessarily deleted
+            log.warn("listing truncated, skipping deletions", n=len(results))
+        elif reconcile:
+            listed = {r.id for r in results}
+            deleted = [i for i in versions if i not in listed]
+            self.store.delete(deleted)
+            changes.extend(PageChange("deleted", i, None, None) for i in deleted)
+
+        if failed:
+            # The pages are listed again by the next run
+            log.warn("pages not retrieved, keeping watermark", page_ids=failed)
+        elif truncated:
+            modified = [
+                datetime.fromisoformat(r.modified) for r in results if r.modified
+            ]
+            newest = max(modified, default=None)
+            if newest and (not watermark or newest > watermark):
+                self.store.set_watermark(newest.astimezone(timezone.utc))
+            log.warn(
+                "listing truncated, continuing next run",
+                n=len(results),
+                watermark=newest,
+            )
+        else:
+            self.store.set_watermark(started)
+        log.info(
+            "synchronized",
+            n_listed=len(results),
+            n_updated=sum(1 for c in changes if c.kind == "updated"),
+            n_deleted=sum(1 for c in changes if c.kind == "deleted"),
+        )
+
+        if changes:
+            for subscriber in self.subscribers:
+                if inspect.isawaitable(pending := subscriber(changes)):
+                    await pending
+
+        return changes
@@ -1,39 +1,223 @@
-from langchain.evaluation.embedding_distance import EmbeddingDistanceEvalChain
+import asyncio
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
 from os import environ
 import numpy as np
 import structlog
+from util.scoring import normalize, top_k
 
 log = structlog.get_logger(emitter="embedding")
 
 
-def embedding_distance(
-    text: str,
-    embedding_model,
-    embedding_chain: EmbeddingDistanceEvalChain,
-    question_embedding: list[float],
-) -> float:
-    """Chunk a text, embed each chunk and the return the closest distance to question_embedding"""
+class EmbeddingCache:
+    """Persistent, content-addressed cache of embeddings.
 
-    # Split page into chunks
+    Embeddings are stored as float32 blobs in SQLite and are keyed by the embedding model's
+    name and the SHA-256 hash of the embedded text. Once more than max_entries embeddings are
+    stored, the least recently used ones are evicted. Reads only record when embeddings were
+    used, the times are written in batches (at the latest with the next write).
+    """
+
+    def __init__(self, path: str, max_entries: int = 200_000):
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Last use of cached embeddings that is not written yet, keyed by model and hash
+        self.used: dict[tuple[str, str], float] = {}
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, hash)
+            )""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: list[str]) -> list[np.ndarray | None]:
+        """Return the cached embedding of every text or None if it is not cached"""
+        hashes = [self.text_hash(t) for t in texts]
+        found: dict[str, np.ndarray] = {}
+
+        with self.lock:
+            # SQLite limits the number of variables in a single statement
+            for s in range(0, len(hashes), 500):
+                batch = hashes[s : s + 500]
+                rows = self.connection.execute(
+                    f"""SELECT hash, vector FROM embeddings
+                    WHERE model = ? AND hash IN ({",".join("?" * len(batch))})""",
+                    [model, *batch],
+                ).fetchall()
+                found.update((h, np.frombuffer(v, dtype=np.float32)) for h, v in rows)
+
+            now = time.time()
+            self.used.update(((model, h), now) for h in found)
+            if len(self.used) >= 1000:
+                self.write_used()
+                self.connection.commit()
+
+        embeddings = [found.get(h) for h in hashes]
+        hits = sum(1 for e in embeddings if e is not None)
+        self.hits += hits
+        self.misses += len(embeddings) - hits
+
+        return embeddings
+
+    def put_many(self, model: str, texts: list[str], embeddings: list[list[float]]):
+        """Store embeddings and evict the least recently used ones if the cache is full"""
+        now = time.time()
+        rows = [
+            (model, self.text_hash(t), np.asarray(e, dtype=np.float32).tobytes(), now)
+            for t, e in zip(texts, embeddings)
+        ]
+
+        with self.lock:
+            # Eviction relies on the recorded uses
+            self.write_used()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows
+            )
+            (n,) = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if n > self.max_entries:
+                self.connection.execute(
+                    """DELETE FROM embeddings WHERE rowid IN (
+                        SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?
+                    )""",
+                    [n - self.max_entries],
+                )
+                log.info("evicted embeddings", n=n - self.max_entries)
+            self.connection.commit()
+
+    def write_used(self):
+        """Write the recorded uses, the caller holds the lock and commits"""
+        self.connection.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+            [(t, model, h) for (model, h), t in self.used.items()],
+        )
+        self.used.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+@functools.cache
+def embedding_cache() -> EmbeddingCache:
+    """Process-wide embedding cache, configured using the environment"""
+    return EmbeddingCache(
+        environ.get("EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite"),
+        int(environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 200_000)),
+    )
+
+
+async def cached_embed(texts: list[str], aembed_batch) -> list[np.ndarray]:
+    """Embed texts, only sending the texts that are not yet cached to the embedding model"""
+    model = environ["EMBEDDING_NAME"]
+    cache = embedding_cache()
+    # SQLite is accessed in a worker thread to not block the event loop
+    embeddings = await asyncio.to_thread(cache.get_many, model, texts)
+
+    # Embed every missing text once, even if it occurs multiple times
+    missing = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+    if missing:
+        new_embeddings = await aembed_batch(missing)
+        await asyncio.to_thread(cache.put_many, model, missing, new_embeddings)
+        embedded = {
+            t: np.asarray(e, dtype=np.float32) for t, e in zip(missing, new_embeddings)
+        }
+        embeddings = [
+            e if e is not None else embedded[t] for t, e in zip(texts, embeddings)
+        ]
+
+    log.info("embedding cache", n=len(texts), embedded=len(missing), **cache.stats())
+    return embeddings
+
+
+def chunk_text(text: str) -> list[str]:
+    """Split a text into overlapping chunks that fit the embedding model"""
     # We assume that a token is generated for about every 2 characters (very conservative)
     chunk_size = int(environ["MAX_EMBEDDING_CHARACTERS"])
     chunk_overlap = int(chunk_size / 8)
 
-    texts = [
+    return [
         text[s : s + chunk_size]
         for s in range(0, len(text), chunk_size - chunk_overlap)
     ]
-    log.info("text lengths", t=[len(t) for t in texts])
 
-    # Embed each page and calculate embedding distances
-    embeddings: list[list[float]] = [
-        embedding_model(f"""passage: {t}""") for t in texts
-    ]
-    distances: list[float] = [
-        embedding_chain._compute_score(np.array([question_embedding, e]))
-        for e in embeddings
-    ]
-    # We use the min distance
-    min_distance = min(distances)
 
-    return min_distance
+async def embed_chunks(texts: list[str], aembed_batch) -> tuple[np.ndarray, np.ndarray]:
+    """Chunk all texts and embed every chunk in batches.
+
+    Returns the normalized chunk embeddings as one float32 matrix and the index of the text
+    each chunk belongs to.
+    """
+    # Split every text into chunks and remember which text each chunk belongs to
+    chunks: list[str] = []
+    owners: list[int] = []
+    for i, text in enumerate(texts):
+        text_chunks = chunk_text(text)
+        chunks.extend(text_chunks)
+        owners.extend([i] * len(text_chunks))
+    log.info("embedding chunks", n_texts=len(texts), n_chunks=len(chunks))
+
+    if not chunks:
+        return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.intp)
+
+    # Embed the chunks of all texts together
+    embeddings = await cached_embed([f"passage: {c}" for c in chunks], aembed_batch)
+
+    return normalize(np.vstack(embeddings)), np.array(owners, dtype=np.intp)
+
+
+async def rank_texts(
+    texts: list[str],
+    aembed_batch,
+    question_embedding: np.ndarray,
+    k: int | None = None,
+) -> list[tuple[int, float]]:
+    """Return the index and distance of the k texts closest to question_embedding, closest first"""
+    chunk_embeddings, owners = await embed_chunks(texts, aembed_batch)
+    indices, distances = top_k(
+        question_embedding, chunk_embeddings, owners, len(texts), k
+    )
+    return list(zip(indices.tolist(), distances.tolist()))
+
+
+async def retrieve_chunks(
+    texts: list[str], queries: list[str], aembed_batch, k: int
+) -> list[list[str]]:
+    """Return the k chunks of all texts that are closest to every query, closest first"""
+    chunks = [c for text in texts for c in chunk_text(text)]
+    if not chunks or not queries:
+        return [[] for _ in queries]
+
+    chunk_embeddings, _ = await embed_chunks(texts, aembed_batch)
+    query_embeddings = normalize(
+        np.vstack(await cached_embed([f"query: {q}" for q in queries], aembed_batch))
+    )
+
+    # Score all queries against all chunks at once
+    similarities = query_embeddings @ chunk_embeddings.T
+    closest = np.argsort(-similarities, axis=1, kind="stable")[:, :k]
+    return [[chunks[j] for j in row] for row in closest.tolist()]
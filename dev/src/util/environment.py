@@ -5,9 +5,12 @@ from dotenv import load_dotenv
 from util.log_format import setup_global_logging
 from shared.configuration import initialize_configuration
 from shared.state import GraphState
+from util.http_pool import ClientPool
 
 
-def setup_config_state(query: str | None = None) -> tuple[dict, dict]:
+async def setup_config_state(
+    query: str | None = None, client_pool: ClientPool | None = None
+) -> tuple[dict, dict]:
     setup_global_logging()
     log = structlog.get_logger(emitter="setup")
     load_dotenv(override=True)
@@ -31,11 +34,12 @@ def setup_config_state(query: str | None = None) -> tuple[dict, dict]:
 
     # https://python.langchain.com/docs/how_to/runnable_runtime_secrets/
     config = {
-        "configurable": initialize_configuration(
+        "configurable": await initialize_configuration(
             confluence_token=confluence_token,
             user_question=query,
             rocket_token=rocket_token,
             rocket_id=rocket_id,
+            client_pool=client_pool,
         )
     }
 
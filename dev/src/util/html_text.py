@@ -0,0 +1,98 @@
+import asyncio
+import re
+from concurrent.futures import ProcessPoolExecutor
+from os import environ
+
+from lxml import etree, html
+
+#
+# Converts Confluence storage format (XHTML with ac:/ri: macros) to plain text
+#
+
+# Elements that are removed together with their content
+SKIPPED = {"script", "style", "ac:parameter", "ri:attachment"}
+# Elements whose text is separated from the surrounding text
+BLOCKS = {
+    "p", "div", "br", "li", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6",
+    "table", "tr", "thead", "tbody", "pre", "blockquote", "hr",
+    "ac:structured-macro", "ac:rich-text-body", "ac:plain-text-body",
+    "ac:task", "ac:layout-section", "ac:layout-cell",
+}  # fmt: skip
+CELLS = {"td", "th"}
+
+CDATA = re.compile(r"<!\[CDATA\[(.*?)\]\]>", re.DOTALL)
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def _escape_cdata(match: re.Match) -> str:
+    # The HTML parser drops CDATA sections (e.g. code macros), keep their content as text
+    return (
+        match.group(1).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    )
+
+
+def html_to_text(content: str) -> str:
+    """Convert (Confluence) HTML to a single line of text in one pass over the parsed tree.
+
+    Block elements are separated by whitespace and table cells by " | ", so the text of
+    neighboring paragraphs and cells is not glued together.
+    """
+    if not content or not content.strip():
+        return ""
+
+    try:
+        root = html.fromstring(CDATA.sub(_escape_cdata, content))
+    except etree.ParserError:
+        # Documents without elements (e.g. only a comment) are empty
+        return ""
+    parts: list[str] = []
+
+    walker = etree.iterwalk(root, events=("start", "end"))
+    for event, element in walker:
+        tag = element.tag if isinstance(element.tag, str) else None
+        if event == "start":
+            if tag in SKIPPED or not tag:
+                walker.skip_subtree()
+                continue
+            if tag in BLOCKS:
+                parts.append(" ")
+            elif tag in CELLS:
+                # Separate the cells of a row
+                parts.append(" | " if element.getprevious() is not None else " ")
+            if element.text:
+                parts.append(element.text)
+        else:
+            if tag in BLOCKS:
+                parts.append(" ")
+            # The tail is the text after the element, it belongs to the parent
+            if element.tail and element is not root:
+                parts.append(element.tail)
+
+    return " ".join("".join(parts).split())
+
+
+def _process_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=int(environ.get("CLEAN_HTML_PROCESSES", 2))
+        )
+    return _pool
+
+
+def shutdown_process_pool():
+    """Stop the worker processes, a new pool is started by the next conversion"""
+    global _pool
+    pool, _pool = _pool, None
+    if pool:
+        pool.shutdown(cancel_futures=True)
+
+
+async def ahtml_to_text(content: str) -> str:
+    """Convert HTML to text, large documents are converted in a process pool to not block the event loop"""
+    if len(content) < int(environ.get("CLEAN_HTML_PROCESS_THRESHOLD", 200_000)):
+        return html_to_text(content)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_process_pool(), html_to_text, content)
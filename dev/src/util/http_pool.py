@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import importlib.util
+import time
+from os import environ
+
+import structlog
+from httpx import AsyncClient, Limits
+
+#
+# Process-wide pool of HTTP clients, connections are kept alive and reused across requests
+#
+
+log = structlog.get_logger(emitter="http_pool")
+
+
+class ClientPool:
+    """Pool of httpx.AsyncClients keyed by service and credential.
+
+    Every client keeps its connections alive, so subsequent requests of the same user skip the
+    TCP/TLS handshakes. Every get leases a client until it is released, clients without leases
+    that were not used for idle_timeout seconds are closed.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30,
+        idle_timeout: float = 600,
+        http2: bool = False,
+    ):
+        self.limits = Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.idle_timeout = idle_timeout
+        # HTTP/2 requires the optional h2 package
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        if http2 and not self.http2:
+            log.warn("h2 is not installed, falling back to HTTP/1.1")
+
+        self.clients: dict[str, AsyncClient] = {}
+        self.last_used: dict[str, float] = {}
+        self.leases: dict[str, int] = {}
+
+    @classmethod
+    def from_environment(cls) -> "ClientPool":
+        return cls(
+            max_connections=int(environ.get("HTTP_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(environ.get("HTTP_MAX_KEEPALIVE", 20)),
+            idle_timeout=float(environ.get("HTTP_IDLE_TIMEOUT", 600)),
+            http2=environ.get("HTTP2", "false").lower() == "true",
+        )
+
+    def get(self, service: str, headers: dict, timeout: float = 5) -> AsyncClient:
+        """Lease the client of a service and credential (contained in headers), creating it if necessary"""
+        credential = "\n".join(f"{k}:{v}" for k, v in sorted(headers.items()))
+        key = hashlib.sha256(f"{service}\n{credential}".encode()).hexdigest()
+
+        if key not in self.clients:
+            log.info("creating client", service=service, n=len(self.clients) + 1)
+
+            async def touch(_):
+                self.last_used[key] = time.monotonic()
+
+            self.clients[key] = AsyncClient(
+                headers=headers,
+                timeout=timeout,
+                limits=self.limits,
+                http2=self.http2,
+                event_hooks={"request": [touch]},
+            )
+        self.last_used[key] = time.monotonic()
+        self.leases[key] = self.leases.get(key, 0) + 1
+
+        return self.clients[key]
+
+    def release(self, client: AsyncClient):
+        """Return a leased client, it can be evicted once it has no leases"""
+        for key, c in self.clients.items():
+            if c is client:
+                self.leases[key] -= 1
+                self.last_used[key] = time.monotonic()
+                if not self.leases[key]:
+                    del self.leases[key]
+                return
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        idle = [
+            k
+            for k, t in self.last_used.items()
+            if now - t > self.idle_timeout and k not in self.leases
+        ]
+        for key in idle:
+            client = self.clients.pop(key)
+            del self.last_used[key]
+            await client.aclose()
+        if idle:
+            log.info("evicted idle clients", n=len(idle), remaining=len(self.clients))
+
+    async def run_eviction(self, interval: float = 60):
+        """Periodically close idle clients, runs until it is cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.evict_idle()
+
+    async def aclose(self):
+        clients = list(self.clients.values())
+        self.clients.clear()
+        self.last_used.clear()
+        self.leases.clear()
+        await asyncio.gather(*[c.aclose() for c in clients])
+        log.info("closed clients", n=len(clients))
@@ -0,0 +1,232 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from os import environ
+
+import structlog
+from jinja2 import Environment, meta
+from langchain_core.messages import BaseMessage
+from pydantic import BaseModel
+
+#
+# Exact-match cache of structured LLM responses, keyed by model, prompt and output schema
+#
+
+log = structlog.get_logger(emitter="llm_cache")
+
+
+class MemoryBackend:
+    """In-memory LRU backend"""
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[str, float] | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, template: str, value: str):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SQLiteBackend:
+    """Persistent backend, the least recently used entries are evicted beyond max_entries.
+
+    Reads only record when entries were used, the times are written in batches (at the
+    latest with the next write).
+    """
+
+    def __init__(self, path: str, max_entries: int = 100_000):
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_entries = max_entries
+        # Last use of entries that is not written yet, keyed by cache key
+        self.used: dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                template TEXT NOT NULL,
+                value TEXT NOT NULL,
+                stored REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self.connection.commit()
+        (self.size,) = self.connection.execute(
+            "SELECT COUNT(*) FROM responses"
+        ).fetchone()
+
+    def get(self, key: str) -> tuple[str, float] | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, stored FROM responses WHERE key = ?", [key]
+            ).fetchone()
+            if row:
+                self.used[key] = time.time()
+                if len(self.used) >= 1000:
+                    self.write_used()
+                    self.connection.commit()
+        return row
+
+    def put(self, key: str, template: str, value: str):
+        now = time.time()
+        with self.lock:
+            # Eviction relies on the recorded uses
+            self.write_used()
+            exists = self.connection.execute(
+                "SELECT 1 FROM responses WHERE key = ?", [key]
+            ).fetchone()
+            self.size += 0 if exists else 1
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                [key, template, value, now, now],
+            )
+            if self.size > self.max_entries:
+                self.connection.execute(
+                    """DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY last_used LIMIT ?
+                    )""",
+                    [self.size - self.max_entries],
+                )
+                self.size = self.max_entries
+            self.connection.commit()
+
+    def write_used(self):
+        """Write the recorded uses, the caller holds the lock and commits"""
+        self.connection.executemany(
+            "UPDATE responses SET last_used = ? WHERE key = ?",
+            [(t, key) for key, t in self.used.items()],
+        )
+        self.used.clear()
+
+
+class LLMCache:
+    """Caches the structured responses of LLMs.
+
+    Responses are keyed by the model, the SHA-256 hash of the prompt messages and the JSON
+    schema of the structured output. Entries are valid for ttl seconds. Hits and misses are
+    counted per template.
+    """
+
+    def __init__(self, backend: MemoryBackend | SQLiteBackend, ttl: float = 60 * 60):
+        self.backend = backend
+        self.ttl = ttl
+        self.statistics: dict[str, dict[str, int]] = {}
+
+    @staticmethod
+    def key(llm, structure: type[BaseModel], messages: list[BaseMessage | str]) -> str:
+        model = "\n".join(
+            str(getattr(llm, a, ""))
+            for a in ["model_name", "temperature", "max_tokens", "openai_api_base"]
+        )
+        prompt = json.dumps(
+            [
+                ("human", m) if isinstance(m, str) else (m.type, m.content)
+                for m in messages
+            ]
+        )
+        schema = json.dumps(structure.model_json_schema(), sort_keys=True)
+        return hashlib.sha256(f"{model}\n{prompt}\n{schema}".encode()).hexdigest()
+
+    def count(self, template: str, event: str):
+        statistics = self.statistics.setdefault(template, {"hits": 0, "misses": 0})
+        statistics[event] += 1
+
+    def get(self, key: str, template: str, structure: type[BaseModel]):
+        entry = self.backend.get(key)
+        if entry and time.time() - entry[1] < self.ttl:
+            self.count(template, "hits")
+            log.info("llm cache hit", template=template, **self.statistics[template])
+            return structure.model_validate_json(entry[0])
+
+        self.count(template, "misses")
+        return None
+
+    def put(self, key: str, template: str, response: BaseModel):
+        self.backend.put(key, template, response.model_dump_json())
+
+
+@functools.cache
+def llm_cache() -> LLMCache | None:
+    """Process-wide LLM cache, configured using the environment (None if it is disabled)"""
+    backend = environ.get("LLM_CACHE", "memory")
+    max_entries = int(environ.get("LLM_CACHE_MAX_ENTRIES", 10_000))
+    if backend == "off":
+        return None
+    if backend == "sqlite":
+        return LLMCache(
+            SQLiteBackend(
+                environ.get("LLM_CACHE_PATH", "./cache/llm.sqlite"), max_entries
+            ),
+            ttl=float(environ.get("LLM_CACHE_TTL", 60 * 60)),
+        )
+    return LLMCache(
+        MemoryBackend(max_entries), ttl=float(environ.get("LLM_CACHE_TTL", 60 * 60))
+    )
+
+
+_template_variables: dict[str, set[str]] = {}
+
+
+def template_variables(environment: Environment, name: str) -> set[str]:
+    """Return the undeclared variables of a template and all templates it includes"""
+    if name not in _template_variables:
+        source = environment.loader.get_source(environment, name)[0]
+        ast = environment.parse(source)
+        variables = set(meta.find_undeclared_variables(ast))
+        for included in meta.find_referenced_templates(ast):
+            if included:
+                variables |= template_variables(environment, included)
+        _template_variables[name] = variables
+    return _template_variables[name]
+
+
+def is_cacheable(environment: Environment, name: str) -> bool:
+    """Templates that embed the current time are not cached if LLM_CACHE_SKIP_NOW is set"""
+    if environ.get("LLM_CACHE_SKIP_NOW", "false").lower() != "true":
+        return True
+    return "now" not in template_variables(environment, name)
+
+
+async def cached_invoke(
+    llm,
+    structure: type[BaseModel],
+    messages: list[BaseMessage | str],
+    template: str,
+    cache: bool = True,
+):
+    """Invoke an LLM with structured output, identical requests are answered from the LLM cache"""
+    responses = llm_cache() if cache else None
+    if not responses:
+        return await llm.with_structured_output(structure).ainvoke(messages)
+
+    key = responses.key(llm, structure, messages)
+    # The SQLite backend is accessed in a worker thread to not block the event loop
+    response = await asyncio.to_thread(responses.get, key, template, structure)
+    if response is not None:
+        return response
+
+    response = await llm.with_structured_output(structure).ainvoke(messages)
+    if isinstance(response, BaseModel):
+        await asyncio.to_thread(responses.put, key, template, response)
+    return response
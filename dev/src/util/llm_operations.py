@@ -1,8 +1,15 @@
+import asyncio
+from os import environ
+
 import structlog
 from langchain_core.messages import SystemMessage
 from langchain_core.runnables import RunnableConfig
 from shared.configuration import ConfigSchema
-from prompts.general import Hallucination
+from prompts.general import Hallucination, Hallucinations
+from util.llm_cache import cached_invoke, is_cacheable
+from util.embedding import retrieve_chunks
+from util.support import split_claims, support_score
+from util.tokens import count_tokens, remaining_budget, truncate
 
 log = structlog.get_logger(emitter="llm_operations")
 
@@ -14,18 +21,171 @@ async def is_hallucination(
     llm = configurable["models"]["default/llm"]
     template_environment = configurable["template_environment"]
 
-    prompt = template_environment.get_template("general/is_hallucination.j2")
-    prompt = prompt.render(
+    template = template_environment.get_template("general/is_hallucination.j2")
+    variables = {"document": "", "claim": claim, "leniency": leniency}
+    if (budget := remaining_budget(template, variables)) is not None:
+        document = truncate(document, budget, template.name)
+    prompt = template.render({**variables, "document": document})
+
+    response: Hallucination = await cached_invoke(
+        llm,
+        Hallucination,
+        [SystemMessage(content=prompt)],
+        template.name,
+        is_cacheable(template_environment, template.name),
+    )
+    log.info("hallucination check", content=response.hallucination)
+
+    return response
+
+
+async def are_hallucinations(
+    claims: list[tuple[str, str]],
+    config: RunnableConfig,
+    leniency: bool = False,
+    batched: bool = True,
+) -> list[Hallucination]:
+    """Check a list of (document, claim) pairs, returning one verdict per pair.
+
+    Claims whose sentences overlap with their document (see support_score) are accepted
+    without calling the LLM, their observation states the support score instead of an
+    observation of the LLM. The remaining claims are checked together in batches that fit
+    into the token budget of the batch template, without a budget in batches of at most
+    HALLUCINATION_BATCH_CHARACTERS document characters. Without batched every remaining
+    claim is checked concurrently in its own request.
+    """
+    threshold = float(environ.get("HALLUCINATION_SUPPORT_THRESHOLD", 0.6))
+    template = config["configurable"]["template_environment"].get_template(
+        "general/is_hallucination_batch.j2"
+    )
+    budget = remaining_budget(template, {"items": [], "leniency": leniency})
+    limit = budget
+    if budget is None:
+        limit = int(environ.get("HALLUCINATION_BATCH_CHARACTERS", 16_000))
+
+    def cost(i: int) -> int:
+        if budget is None:
+            return len(claims[i][0])
+        # The headers of every item are counted with the claim
+        return count_tokens(claims[i][0]) + count_tokens(claims[i][1]) + 16
+
+    verdicts: list[Hallucination | None] = [None] * len(claims)
+    flagged: list[int] = []
+    for i, (document, claim) in enumerate(claims):
+        if (score := support_score(document, claim)) >= threshold:
+            verdicts[i] = Hallucination(
+                observations=f"Accepted without LLM check, {score:.0%} of the claim's word pairs are contained in the document.",
+                hallucination=False,
+            )
+        else:
+            flagged.append(i)
+    log.info("local support check", n=len(claims), n_flagged=len(flagged))
+
+    # Claims that exceed the limit on their own are checked (and truncated) by is_hallucination
+    batches: list[list[int]] = []
+    used = 0
+    for i in flagged:
+        if not batches or not batched or used + cost(i) > limit:
+            batches.append([])
+            used = 0
+        batches[-1].append(i)
+        used += cost(i)
+
+    async def check(batch: list[int]):
+        if len(batch) == 1:
+            document, claim = claims[batch[0]]
+            verdicts[batch[0]] = await is_hallucination(
+                document, claim, config, leniency
+            )
+            return
+
+        results = await is_hallucination_batch(
+            [claims[i] for i in batch], config, leniency
+        )
+        for i, result in zip(batch, results):
+            verdicts[i] = result
+
+        # Claims without a verdict are checked on their own
+        await asyncio.gather(*[check([i]) for i in batch if not verdicts[i]])
+
+    await asyncio.gather(*[check(b) for b in batches])
+    return verdicts
+
+
+async def is_hallucination_batch(
+    claims: list[tuple[str, str]], config: RunnableConfig, leniency: bool = False
+) -> list[Hallucination | None]:
+    """Check multiple (document, claim) pairs with a single request, None for claims the LLM did not answer"""
+    configurable: ConfigSchema = config["configurable"]
+    llm = configurable["models"]["default/llm"]
+    template_environment = configurable["template_environment"]
+
+    template = template_environment.get_template("general/is_hallucination_batch.j2")
+    prompt = template.render(
         {
-            "document": document,
-            "claim": claim,
+            "items": [{"document": d, "claim": c} for d, c in claims],
             "leniency": leniency,
         }
     )
 
-    response: Hallucination = await llm.with_structured_output(Hallucination).ainvoke(
-        [SystemMessage(content=prompt)]
+    response: Hallucinations = await cached_invoke(
+        llm,
+        Hallucinations,
+        [SystemMessage(content=prompt)],
+        template.name,
+        is_cacheable(template_environment, template.name),
+    )
+    verdicts = {
+        v.claim: Hallucination(
+            observations=v.observations, hallucination=v.hallucination
+        )
+        for v in response.verdicts
+    }
+    log.info(
+        "batched hallucination check",
+        n=len(claims),
+        n_answered=len(verdicts),
+        hallucinations=[v.hallucination for v in verdicts.values()],
     )
-    log.info("hallucination check", content=response.hallucination)
 
-    return response
+    return [verdicts.get(i + 1) for i in range(len(claims))]
+
+
+async def verify_answer(
+    documents: list[str], answer: str, config: RunnableConfig
+) -> Hallucination:
+    """Check an answer claim by claim, every claim is only compared with the document chunks closest to it"""
+    configurable: ConfigSchema = config["configurable"]
+    aembed_batch = configurable["models"]["default/aembed_batch"]
+
+    claims = split_claims(answer) or split_claims(answer, min_words=1)
+    if not claims:
+        return Hallucination(
+            observations="The answer does not contain any claims.",
+            hallucination=False,
+        )
+    evidence = await retrieve_chunks(
+        documents,
+        claims,
+        aembed_batch,
+        k=int(environ.get("HALLUCINATION_EVIDENCE_CHUNKS", 3)),
+    )
+    log.info("verifying answer", n_claims=len(claims), n_documents=len(documents))
+
+    hallucinations = await are_hallucinations(
+        [(" ... ".join(chunks), claim) for chunks, claim in zip(evidence, claims)],
+        config,
+        leniency=True,
+        batched=False,
+    )
+
+    failed = [(c, h) for c, h in zip(claims, hallucinations) if h.hallucination]
+    if not failed:
+        return Hallucination(
+            observations=f"All {len(claims)} claims are contained in the documents.",
+            hallucination=False,
+        )
+    return Hallucination(
+        observations="\n".join(f'- "{c}" {h.observations}' for c, h in failed),
+        hallucination=True,
+    )
@@ -0,0 +1,172 @@
+import functools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from os import environ
+
+import structlog
+
+log = structlog.get_logger(emitter="page_cache")
+
+
+@dataclass
+class CachedPage:
+    """
+    Represents the cleaned body of a Confluence page.
+
+    :param page_id: The content id of the page.
+    :param version: The version number of the page, if it is known.
+    :param etag: The ETag header the page was downloaded with, if the server sent one.
+    :param body: The cleaned text of the page.
+    :param stored: Unix timestamp of the last download or revalidation.
+    """
+
+    page_id: str
+    version: int | None
+    etag: str | None
+    body: str
+    stored: float
+
+
+class PageCache:
+    """Two-tier (in-memory LRU and SQLite) cache of cleaned Confluence page bodies.
+
+    Entries are keyed by content id and version. If the version of a page is known, a cached
+    entry with the same version is always valid. Otherwise, entries are valid for ttl seconds
+    and have to be revalidated afterwards. Reads only record when entries were used, the times
+    are written in batches (at the latest with the next write).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 24 * 60 * 60,
+        max_memory_entries: int = 1_000,
+        max_disk_entries: int = 50_000,
+    ):
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory: OrderedDict[str, CachedPage] = OrderedDict()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        # Last use of entries that is not written yet, keyed by content id
+        self.used: dict[str, float] = {}
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS pages (
+                id TEXT PRIMARY KEY,
+                version INTEGER,
+                etag TEXT,
+                body TEXT NOT NULL,
+                stored REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)"
+        )
+        self.connection.commit()
+        (self.size,) = self.connection.execute("SELECT COUNT(*) FROM pages").fetchone()
+
+    def get(self, page_id: str) -> CachedPage | None:
+        """Return the latest cached entry of a page, regardless of its freshness"""
+        with self.lock:
+            if entry := self.memory.get(page_id):
+                self.memory.move_to_end(page_id)
+                return entry
+
+            row = self.connection.execute(
+                "SELECT id, version, etag, body, stored FROM pages WHERE id = ?",
+                [page_id],
+            ).fetchone()
+            if not row:
+                return None
+            self.used[page_id] = time.time()
+            if len(self.used) >= 1000:
+                self.write_used()
+                self.connection.commit()
+
+        entry = CachedPage(*row)
+        self.remember(entry)
+        return entry
+
+    def is_fresh(self, entry: CachedPage, version: int | None) -> bool:
+        """An entry is fresh if it has the requested version or, if the version is unknown, is younger than the ttl"""
+        if version is not None and entry.version is not None:
+            return version == entry.version
+        return time.time() - entry.stored < self.ttl
+
+    def put(self, entry: CachedPage):
+        self.remember(entry)
+        with self.lock:
+            # Eviction relies on the recorded uses
+            self.write_used()
+            exists = self.connection.execute(
+                "SELECT 1 FROM pages WHERE id = ?", [entry.page_id]
+            ).fetchone()
+            self.size += 0 if exists else 1
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    entry.page_id,
+                    entry.version,
+                    entry.etag,
+                    entry.body,
+                    entry.stored,
+                    time.time(),
+                ],
+            )
+            if self.size > self.max_disk_entries:
+                self.connection.execute(
+                    """DELETE FROM pages WHERE id IN (
+                        SELECT id FROM pages ORDER BY last_used LIMIT ?
+                    )""",
+                    [self.size - self.max_disk_entries],
+                )
+                self.size = self.max_disk_entries
+            self.connection.commit()
+
+    def write_used(self):
+        """Write the recorded uses, the caller holds the lock and commits"""
+        self.connection.executemany(
+            "UPDATE pages SET last_used = ? WHERE id = ?",
+            [(t, page_id) for page_id, t in self.used.items()],
+        )
+        self.used.clear()
+
+    def remember(self, entry: CachedPage):
+        """Store an entry in the in-memory LRU"""
+        with self.lock:
+            self.memory[entry.page_id] = entry
+            self.memory.move_to_end(entry.page_id)
+            while len(self.memory) > self.max_memory_entries:
+                self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.revalidations + self.misses
+        return {
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.revalidations) / total if total else 0.0,
+        }
+
+
+@functools.cache
+def page_cache() -> PageCache:
+    """Process-wide page cache, configured using the environment"""
+    return PageCache(
+        environ.get("PAGE_CACHE_PATH", "./cache/pages.sqlite"),
+        ttl=float(environ.get("PAGE_CACHE_TTL", 24 * 60 * 60)),
+        max_memory_entries=int(environ.get("PAGE_CACHE_MAX_MEMORY_ENTRIES", 1_000)),
+        max_disk_entries=int(environ.get("PAGE_CACHE_MAX_DISK_ENTRIES", 50_000)),
+    )
@@ -0,0 +1,134 @@
+import functools
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from os import environ
+
+#
+# Process-wide caches of Rocket.Chat rooms (per user), user names and threads (global)
+#
+
+
+@dataclass
+class RoomCacheEntry:
+    """
+    Represents the rooms a user is part of.
+
+    :param rooms: Raw API objects of the rooms, keyed by room id.
+    :param updated_since: Server timestamp of the last refresh, used as updatedSince in the next refresh.
+    :param refreshed: Local (monotonic) time of the last refresh.
+    :param created: Local (monotonic) time of the last full refresh.
+    """
+
+    rooms: dict[str, dict] = field(default_factory=dict)
+    updated_since: str | None = None
+    refreshed: float = 0.0
+    created: float = 0.0
+
+
+@dataclass
+class ThreadCacheEntry:
+    """
+    Represents the messages of a thread.
+
+    :param messages: The RocketChatMessages of the thread, ordered by timestamp.
+    :param updated_since: Timestamp of the last retrieval, used as updatedSince in the next sync.
+    :param refreshed: Local (monotonic) time of the last retrieval.
+    :param complete: Whether all messages of the thread were retrieved (not only the first page).
+    """
+
+    messages: list
+    updated_since: str
+    refreshed: float
+    complete: bool
+
+    @property
+    def tail(self) -> str | None:
+        """The timestamp of the newest cached message"""
+        return max((m.timestamp for m in self.messages), default=None)
+
+
+class RocketCache:
+    """Caches the rooms of every user, the names of all users and the messages of threads.
+
+    Rooms are refreshed incrementally once they are older than room_ttl seconds and fully
+    after full_refresh seconds. User names are valid for user_ttl seconds. Threads are
+    synchronized once a newer last message is known or after thread_ttl seconds, the least
+    recently used threads are evicted beyond max_threads.
+    """
+
+    def __init__(
+        self,
+        room_ttl: float = 60,
+        full_refresh: float = 24 * 60 * 60,
+        user_ttl: float = 24 * 60 * 60,
+        thread_ttl: float = 60,
+        max_threads: int = 1000,
+    ):
+        self.room_ttl = room_ttl
+        self.full_refresh = full_refresh
+        self.user_ttl = user_ttl
+        self.thread_ttl = thread_ttl
+        self.max_threads = max_threads
+
+        self.rooms: dict[str, RoomCacheEntry] = {}
+        self.users: dict[str, tuple[str, float]] = {}
+        self.threads: OrderedDict[str, ThreadCacheEntry] = OrderedDict()
+
+    def room_entry(self, user_id: str) -> RoomCacheEntry:
+        """Return the rooms of a user, a new entry is returned if the cached one needs a full refresh"""
+        entry = self.rooms.get(user_id)
+        if not entry or time.monotonic() - entry.created > self.full_refresh:
+            entry = RoomCacheEntry(created=time.monotonic())
+            self.rooms[user_id] = entry
+        return entry
+
+    def is_fresh(self, entry: RoomCacheEntry) -> bool:
+        return (
+            entry.updated_since is not None
+            and time.monotonic() - entry.refreshed < self.room_ttl
+        )
+
+    def user_names(self, user_ids: list[str]) -> dict[str, str]:
+        """Return the cached names of all users whose names are known and not expired"""
+        now = time.monotonic()
+        return {
+            u: self.users[u][0]
+            for u in user_ids
+            if u in self.users and now - self.users[u][1] < self.user_ttl
+        }
+
+    def set_user_names(self, names: dict[str, str]):
+        now = time.monotonic()
+        self.users.update((u, (name, now)) for u, name in names.items())
+
+    def thread(self, thread_id: str) -> ThreadCacheEntry | None:
+        entry = self.threads.get(thread_id)
+        if entry:
+            self.threads.move_to_end(thread_id)
+        return entry
+
+    def set_thread(self, thread_id: str, entry: ThreadCacheEntry):
+        self.threads[thread_id] = entry
+        self.threads.move_to_end(thread_id)
+        while len(self.threads) > self.max_threads:
+            self.threads.popitem(last=False)
+
+    def is_thread_fresh(
+        self, entry: ThreadCacheEntry, last_message: str | None
+    ) -> bool:
+        """A thread is fresh if it contains its last message (tlm), otherwise if it is younger than thread_ttl"""
+        if last_message:
+            return entry.tail is not None and last_message <= entry.tail
+        return time.monotonic() - entry.refreshed < self.thread_ttl
+
+
+@functools.cache
+def rocket_cache() -> RocketCache:
+    """Process-wide Rocket.Chat cache, configured using the environment"""
+    return RocketCache(
+        room_ttl=float(environ.get("ROCKET_ROOM_TTL", 60)),
+        user_ttl=float(environ.get("ROCKET_USER_TTL", 24 * 60 * 60)),
+        thread_ttl=float(environ.get("ROCKET_THREAD_TTL", 60)),
+        max_threads=int(environ.get("ROCKET_THREAD_CACHE_SIZE", 1000)),
+    )
@@ -1,10 +1,18 @@
 import asyncio
+import json
+import math
+import time
+from contextlib import aclosing
 from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from os import environ
-from typing import Callable, List, TypeVar
+from typing import AsyncIterator, Callable, List, TypeVar
 
 import structlog
 from httpx import AsyncClient
+from util.http_pool import ClientPool
+from util.rocket_cache import RocketCache, ThreadCacheEntry
+from util.scheduler import scheduled_get
 
 T = TypeVar("T")
 
@@ -33,20 +41,21 @@ class ChatRoom:
     @staticmethod
     def from_api_result(base_url: str, chat_identifier: str):
         def builder(result: list[dict]):
-            return [
-                ChatRoom(
-                    room_id=c["_id"],
-                    room_type=c["t"],
-                    usernames=c.get("uids"),
-                    name=c.get("name"),
-                    description=c.get("description"),
-                    url=ChatRoom.room_url(base_url, c),
-                )
-                for c in result[chat_identifier]
-            ]
+            return [ChatRoom.from_room(base_url, c) for c in result[chat_identifier]]
 
         return builder
 
+    @staticmethod
+    def from_room(base_url: str, c: dict):
+        return ChatRoom(
+            room_id=c["_id"],
+            room_type=c["t"],
+            usernames=c.get("uids"),
+            name=c.get("name"),
+            description=c.get("description"),
+            url=ChatRoom.room_url(base_url, c),
+        )
+
     @staticmethod
     def room_url(base_url: str, c: dict):
         t = "channel" if c["t"] == "c" else "direct"
@@ -65,6 +74,8 @@ class RocketChatMessage:
     :param username: The username of the user who sent the message.
     :param user_id: A unique identifier for the user who sent the message.
     :param timestamp: The ISO timestamp of the message.
+    :param thread_last_message: The ISO timestamp of the last message of the thread (if the message starts a thread).
+    :param thread_count: The number of replies of the thread (if the message starts a thread).
     """
 
     message: str
@@ -74,36 +85,115 @@ class RocketChatMessage:
     username: str
     user_id: str
     timestamp: str
+    thread_last_message: str | None = None
+    thread_count: int | None = None
 
     @staticmethod
     def from_chat_search(result: dict):
-        return [
-            RocketChatMessage(
-                message=r["msg"],
-                message_id=r["_id"],
-                thread_id=r.get("tmid"),
-                score=r.get("score"),
-                username=r["u"]["name"],
-                user_id=r["u"]["_id"],
-                timestamp=r["ts"],
-            )
-            for r in result["messages"]
-        ]
+        return [RocketChatMessage.from_message(r) for r in result["messages"]]
 
     @staticmethod
     def from_threaded_result(result: dict):
-        return [
-            RocketChatMessage(
-                message=r["msg"],
-                message_id=r["_id"],
-                thread_id=r["tmid"],
-                score=None,
-                username=r["u"]["name"],
-                user_id=r["u"]["_id"],
-                timestamp=r["ts"],
-            )
-            for r in result["messages"]
+        return [RocketChatMessage.from_message(r) for r in result["messages"]]
+
+    @staticmethod
+    def from_message(r: dict):
+        return RocketChatMessage(
+            message=r["msg"],
+            message_id=r["_id"],
+            thread_id=r.get("tmid"),
+            score=r.get("score"),
+            username=r["u"]["name"],
+            user_id=r["u"]["_id"],
+            timestamp=r["ts"],
+            thread_last_message=r.get("tlm"),
+            thread_count=r.get("tcount"),
+        )
+
+
+class ThreadExcerpt(list):
+    """The messages of a thread around its matching messages, preceded by the thread's first message.
+
+    Behaves like the list of all messages of a thread. The retrieved messages are kept, so the
+    window can be grown without retrieving them again.
+
+    :param thread_id: The identifier of the thread (the id of its first message).
+    :param root: The first message of the thread, None if it is a search result itself.
+    :param messages: All retrieved messages of the thread, ordered by timestamp.
+    :param matches: The identifiers of the matching messages.
+    :param window: The number of messages before and after every match.
+    :param complete: Whether all messages of the thread were retrieved.
+    """
+
+    def __init__(
+        self,
+        thread_id: str,
+        root: RocketChatMessage | None,
+        messages: list[RocketChatMessage],
+        matches: set[str],
+        window: int,
+        complete: bool,
+    ):
+        self.thread_id = thread_id
+        self.root = root
+        self.messages = messages
+        self.matches = matches
+        self.window = window
+        self.complete = complete
+        super().__init__(self.excerpt())
+
+    def positions(self) -> list[int]:
+        return [i for i, m in enumerate(self.messages) if m.message_id in self.matches]
+
+    def is_retrieved(self) -> bool:
+        """Whether every match and the window after the last match were retrieved"""
+        if self.complete:
+            return True
+        positions = self.positions()
+        return (
+            len(positions) == len(self.matches)
+            and max(positions, default=-1) + self.window < len(self.messages)
+        )
+
+    def excerpt(self) -> list[RocketChatMessage]:
+        # Only the windows around located matches are used, never a fallback position
+        positions = self.positions()
+        selected = [
+            m
+            for i, m in enumerate(self.messages)
+            if any(abs(i - p) <= self.window for p in positions)
         ]
+        return ([self.root] if self.root else []) + selected
+
+    def refresh(self):
+        self[:] = self.excerpt()
+
+    def update(self, messages: list[RocketChatMessage], window: int, complete: bool):
+        self.messages = messages
+        self.window = window
+        self.complete = complete
+        self.refresh()
+
+
+def expand_threads(
+    messages: list[RocketChatMessage], threads: dict[str, list[RocketChatMessage]]
+) -> list[RocketChatMessage | list[RocketChatMessage]]:
+    """Replace the first message of every thread with all messages of the thread"""
+    expanded_messages: list[RocketChatMessage | list[RocketChatMessage]] = []
+    seen_thread_ids = set()
+    for message in messages:
+        if message.thread_id and message.thread_id not in seen_thread_ids:
+            # Add the full thread at the position of its first match
+            expanded_messages.append(threads[message.thread_id])
+            seen_thread_ids.add(message.thread_id)
+        elif message.thread_id and message.thread_id in seen_thread_ids:
+            # Skip this message as it's part of a thread that has already been expanded
+            continue
+        else:
+            # This message is not part of a thread, add it as is
+            expanded_messages.append(message)
+
+    return expanded_messages
 
 
 class RocketChatClient:
@@ -113,26 +203,53 @@ class RocketChatClient:
         user_id: str,
         max_items_limit: int = 100,
         step_size: int = 50,
+        max_concurrency: int = 4,
+        client_pool: ClientPool | None = None,
+        rocket_cache: RocketCache | None = None,
     ):
         headers = {
             "Accept": "application/json",
             "X-Auth-Token": token,
             "X-User-Id": user_id,
         }
-        self.client = AsyncClient(headers=headers, timeout=30)
-
         self.base_url = environ["ROCKET_CHAT_URL"]
+        if client_pool:
+            self.client = client_pool.get(self.base_url, headers, timeout=30)
+        else:
+            self.client = AsyncClient(headers=headers, timeout=30)
+
         self.max_items_limit = max_items_limit
         self.step_size = step_size
+        # Limits the concurrent thread retrievals of all searches of this client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Number of messages around a match that are retrieved of threads, 0 retrieves whole threads
+        self.thread_window = int(environ.get("ROCKET_THREAD_WINDOW", 0))
+        self.user_id = user_id
+        self.rocket_cache = rocket_cache
 
     async def search_text(
         self,
         pattern: str,
         chats: list[ChatRoom],
     ) -> list[tuple[ChatRoom, list[RocketChatMessage | list[RocketChatMessage]]]]:
-        results = [self.search_room(pattern, c) for c in chats]
-        results = await asyncio.gather(*results)
-        return [r for r in results if r[1]]
+        results = [r async for r in self.iter_search_text(pattern, chats)]
+        # Keep the order of the chats
+        order = {c.room_id: i for i, c in enumerate(chats)}
+        return sorted(results, key=lambda r: order[r[0].room_id])
+
+    async def iter_search_text(
+        self,
+        pattern: str,
+        chats: list[ChatRoom],
+    ) -> AsyncIterator[
+        tuple[ChatRoom, list[RocketChatMessage | list[RocketChatMessage]]]
+    ]:
+        """Search all chats concurrently and yield the (expanded) results of every chat as soon as it is done"""
+        searches = [self.search_room(pattern, c) for c in chats]
+        for result in asyncio.as_completed(searches):
+            chat, messages = await result
+            if messages:
+                yield chat, messages
 
     async def search_room(
         self,
@@ -140,48 +257,286 @@ class RocketChatClient:
         chat: ChatRoom,
     ) -> tuple[ChatRoom, list[RocketChatMessage | list[RocketChatMessage]]]:
         result = await self.api_chat_search(chat.room_id, pattern)
-        expanded_messages: list[RocketChatMessage | list[RocketChatMessage]] = []
-        seen_thread_ids = set()
-
-        for message in result:
-            if message.thread_id and message.thread_id not in seen_thread_ids:
-                # Retrieve the full thread
-                thread_messages = await self.api_get_threaded_messages(
-                    message.thread_id
+
+        # Retrieve all threads concurrently, every thread only once
+        thread_ids = list(dict.fromkeys(m.thread_id for m in result if m.thread_id))
+        # The last message of a thread is known if its first message was found as well
+        last_messages = {
+            m.message_id: m.thread_last_message for m in result if m.thread_last_message
+        }
+        counts = {m.message_id: m.thread_count for m in result if m.thread_count}
+
+        async def fetch_thread(thread_id: str) -> list[RocketChatMessage]:
+            async with self.semaphore:
+                if not self.thread_window:
+                    return await self.thread_messages(
+                        thread_id, last_messages.get(thread_id), counts.get(thread_id)
+                    )
+                return await self.thread_excerpt(
+                    thread_id,
+                    {m.message_id for m in result if m.thread_id == thread_id},
+                    # The first message does not have to be retrieved if it was found
+                    any(m.message_id == thread_id for m in result),
+                    last_messages.get(thread_id),
                 )
-                expanded_messages.append(thread_messages)
-                seen_thread_ids.add(message.thread_id)
-            elif message.thread_id and message.thread_id in seen_thread_ids:
-                # Skip this message as it's part of a thread that has already been expanded
-                continue
-            else:
-                # This message is not part of a thread, add it as is
-                expanded_messages.append(message)
 
-        return chat, expanded_messages
+        threads = await asyncio.gather(*[fetch_thread(t) for t in thread_ids])
+        threads = dict(zip(thread_ids, threads))
+
+        return chat, expand_threads(result, threads)
+
+    async def thread_messages(
+        self, thread_id: str, last_message: str | None = None, count: int | None = None
+    ) -> list[RocketChatMessage]:
+        """Return the messages of a thread, cached threads are only synchronized with messages newer than their tail"""
+        if not self.rocket_cache:
+            return await self.api_get_threaded_messages(thread_id, count)
+
+        entry = self.rocket_cache.thread(thread_id)
+        if entry and self.rocket_cache.is_thread_fresh(entry, last_message):
+            return entry.messages
+
+        # The overlap accounts for differences between the local and server clocks, updates are idempotent
+        updated_since = datetime.now(timezone.utc) - timedelta(minutes=1)
+        max_messages = 50
+        if entry:
+            update, remove = await self.api_sync_thread_messages(
+                thread_id, entry.updated_since
+            )
+            messages = {m.message_id: m for m in entry.messages}
+            messages.update((m.message_id, m) for m in update)
+            for message_id in remove:
+                messages.pop(message_id, None)
+            messages = sorted(messages.values(), key=lambda m: m.timestamp)
+            complete = entry.complete
+            log.info(
+                "synchronized thread",
+                n_updated=len(update),
+                n_removed=len(remove),
+                n=len(messages),
+            )
+        else:
+            messages = await self.api_get_threaded_messages(
+                thread_id, count, max_messages
+            )
+            # A partial page is the end of the thread
+            complete = len(messages) < max_messages
+        # All replies are known once their number reaches the reply count of the thread
+        complete = complete or (count is not None and len(messages) >= count)
+
+        self.rocket_cache.set_thread(
+            thread_id,
+            ThreadCacheEntry(
+                messages=messages,
+                updated_since=updated_since.isoformat(timespec="milliseconds"),
+                refreshed=time.monotonic(),
+                complete=complete,
+            ),
+        )
+        return messages
+
+    async def thread_excerpt(
+        self,
+        thread_id: str,
+        matches: set[str],
+        root_found: bool,
+        last_message: str | None = None,
+    ) -> ThreadExcerpt:
+        """Return the first message of a thread and thread_window messages around every match.
+
+        Messages are retrieved in pages until every match was located and the window after
+        the last match is complete.
+        """
+        root = None
+        if not root_found:
+            root = asyncio.create_task(self.api_get_message(thread_id))
+
+        # Only complete threads are used, the messages of incomplete ones may contain gaps
+        entry = self.rocket_cache.thread(thread_id) if self.rocket_cache else None
+        if (
+            entry
+            and entry.complete
+            and self.rocket_cache.is_thread_fresh(entry, last_message)
+        ):
+            excerpt = ThreadExcerpt(
+                thread_id, None, entry.messages, matches, self.thread_window, True
+            )
+        else:
+            excerpt = ThreadExcerpt(
+                thread_id, None, [], matches, self.thread_window, False
+            )
+            # Pages are retrieved until every match and its window are located
+            await self.grow_excerpt(excerpt, self.thread_window)
+
+        if root:
+            try:
+                excerpt.root = await root
+                excerpt.refresh()
+            except:
+                log.exception("could not retrieve thread root", thread_id=thread_id)
+        return excerpt
+
+    async def grow_excerpt(
+        self, excerpt: ThreadExcerpt, window: int, limit: int | None = None
+    ):
+        """Grow the window of an excerpt, messages are only retrieved if they were not retrieved yet.
+
+        :param limit: The maximum number of messages of the thread that are retrieved.
+        """
+        excerpt.update(excerpt.messages, window, excerpt.complete)
+        if excerpt.is_retrieved():
+            return
+
+        messages = list(excerpt.messages)
+        limit = None if limit is None else max(0, limit - len(messages))
+        retrieved = 0
+        pages = self.iter_items(
+            f"{self.base_url}/api/v1/chat.getThreadMessages",
+            {
+                "tmid": excerpt.thread_id,
+                "sort": json.dumps({"ts": 1}),
+                "offset": len(messages),
+            },
+            RocketChatMessage.from_threaded_result,
+            limit,
+        )
+        async with aclosing(pages):
+            async for page in pages:
+                messages.extend(page)
+                retrieved += len(page)
+                excerpt.update(messages, window, False)
+                if excerpt.is_retrieved():
+                    complete = False
+                    break
+            else:
+                # The thread may be longer than the limit
+                complete = limit is None or retrieved < limit
+
+        excerpt.update(messages, window, complete)
+        log.info(
+            "retrieved thread excerpt",
+            n_retrieved=len(messages),
+            n_excerpt=len(excerpt),
+            complete=complete,
+        )
+        if len(excerpt.positions()) < len(excerpt.matches):
+            # E.g. deleted messages or a retrieval limit, the excerpt omits these matches
+            log.warn(
+                "matches not found in thread",
+                thread_id=excerpt.thread_id,
+                n_missing=len(excerpt.matches) - len(excerpt.positions()),
+            )
 
     async def retrieve_all_rooms(self) -> list[ChatRoom]:
         try:
-            channels = await self.api_channels_list_joined()
-            dms = await self.api_list_dms()
+            if self.rocket_cache:
+                rooms = await self.cached_rooms()
+            else:
+                channels, dms = await asyncio.gather(
+                    self.api_channels_list_joined(), self.api_list_dms()
+                )
+                rooms = channels + dms
 
-            user_names = [
-                [self.api_get_user_names(u_id) for u_id in dm.usernames] for dm in dms
-            ]
-            user_names = await asyncio.gather(*[asyncio.gather(*u) for u in user_names])
-            for dm, user_names in zip(dms, user_names):
-                dm.usernames = user_names
+            # Replace the user ids of dms with the user's names
+            dms = [r for r in rooms if r.room_type == "d"]
+            names = await self.user_names([u for dm in dms for u in dm.usernames or []])
+            for dm in dms:
+                dm.usernames = [names.get(u, u) for u in dm.usernames or []]
 
-            return channels + dms
+            return rooms
         except:
             log.exception("could not retrieve channels")
             return []
 
+    async def cached_rooms(self) -> list[ChatRoom]:
+        """Return the joined channels and dms of the user, only retrieving rooms that changed since the last request"""
+        entry = self.rocket_cache.room_entry(self.user_id)
+        if not self.rocket_cache.is_fresh(entry):
+            # The overlap accounts for differences between the local and server clocks, updates are idempotent
+            updated_since = datetime.now(timezone.utc) - timedelta(minutes=1)
+            update, remove = await self.api_rooms_get(entry.updated_since)
+            for room in update:
+                entry.rooms[room["_id"]] = room
+            for room in remove:
+                entry.rooms.pop(room["_id"], None)
+            log.info(
+                "refreshed rooms",
+                incremental=entry.updated_since is not None,
+                n_updated=len(update),
+                n_removed=len(remove),
+            )
+            entry.updated_since = updated_since.isoformat(timespec="milliseconds")
+            entry.refreshed = time.monotonic()
+
+        rooms = [ChatRoom.from_room(self.base_url, r) for r in entry.rooms.values()]
+        channels = [r for r in rooms if r.room_type == "c"]
+        dms = [r for r in rooms if r.room_type == "d"]
+        return channels + dms
+
+    async def user_names(self, user_ids: list[str]) -> dict[str, str]:
+        """Return the names of users, using the cache and batched requests for unknown users"""
+        user_ids = list(dict.fromkeys(user_ids))
+        names = self.rocket_cache.user_names(user_ids) if self.rocket_cache else {}
+        missing = [u for u in user_ids if u not in names]
+        if not missing:
+            return names
+
+        retrieved: dict[str, str] = {}
+        try:
+            for s in range(0, len(missing), 100):
+                retrieved.update(await self.api_users_list(missing[s : s + 100]))
+        except:
+            log.exception("could not list users, falling back to users.info")
+
+        # Retrieve users that could not be listed one by one
+        remaining = [u for u in missing if u not in retrieved]
+        results = await asyncio.gather(
+            *[self.api_get_user_names(u) for u in remaining], return_exceptions=True
+        )
+        retrieved.update((u, n) for u, n in zip(remaining, results) if type(n) is str)
+        log.info(
+            "retrieved user names", n_cached=len(names), n_retrieved=len(retrieved)
+        )
+
+        if self.rocket_cache:
+            self.rocket_cache.set_user_names(retrieved)
+        return names | retrieved
+
+    async def api_rooms_get(
+        self, updated_since: str | None = None
+    ) -> tuple[list[dict], list[dict]]:
+        """https://developer.rocket.chat/apidocs/get-rooms"""
+        url = f"{self.base_url}/api/v1/rooms.get"
+        params = {"updatedSince": updated_since} if updated_since else {}
+
+        response = await scheduled_get(self.client, url, params=params)
+        response.raise_for_status()
+        response = response.json()
+        assert response["success"]
+
+        return response.get("update", []), response.get("remove", [])
+
+    async def api_users_list(self, user_ids: list[str]) -> dict[str, str]:
+        """https://developer.rocket.chat/apidocs/get-users-list"""
+        url = f"{self.base_url}/api/v1/users.list"
+        params = {
+            "query": json.dumps({"_id": {"$in": user_ids}}),
+            "fields": json.dumps({"name": 1}),
+            "count": len(user_ids),
+        }
+
+        response = await scheduled_get(self.client, url, params=params)
+        response.raise_for_status()
+        response = response.json()
+        assert response["success"]
+
+        return {u["_id"]: u["name"] for u in response["users"] if "name" in u}
+
     async def api_get_user_names(self, user_id: str) -> str:
         url = f"{self.base_url}/api/v1/users.info"
         params = {"userId": user_id}
 
-        response = await self.client.get(url=url, params=params)
+        response = await scheduled_get(self.client, url, params=params)
         response.raise_for_status()
 
         response = response.json()
@@ -207,6 +562,20 @@ class RocketChatClient:
             url, params, ChatRoom.from_api_result(self.base_url, "channels")
         )
 
+    def iter_room_history(
+        self, room: ChatRoom, oldest: str | None, max_messages: int
+    ) -> AsyncIterator[list[RocketChatMessage]]:
+        """https://developer.rocket.chat/apidocs/get-channel-history, yields messages newer than oldest (newest first)"""
+        endpoint = "channels.history" if room.room_type == "c" else "im.history"
+        url = f"{self.base_url}/api/v1/{endpoint}"
+        params = {"roomId": room.room_id}
+        if oldest:
+            params["oldest"] = oldest
+
+        return self.iter_items(
+            url, params, RocketChatMessage.from_chat_search, max_messages
+        )
+
     async def api_chat_search(
         self,
         chat_id: str,
@@ -217,52 +586,127 @@ class RocketChatClient:
         url = f"{self.base_url}/api/v1/chat.search"
         params = {"roomId": chat_id, "searchText": pattern, "count": count}
 
-        response = await self.client.get(url=url, params=params)
+        response = await scheduled_get(self.client, url, params=params)
         response.raise_for_status()
         response = response.json()
         assert response["success"]
 
         return RocketChatMessage.from_chat_search(response)
 
+    async def api_get_message(self, message_id: str) -> RocketChatMessage:
+        """https://developer.rocket.chat/apidocs/get-message"""
+        url = f"{self.base_url}/api/v1/chat.getMessage"
+        params = {"msgId": message_id}
+
+        response = await scheduled_get(self.client, url, params=params)
+        response.raise_for_status()
+        response = response.json()
+        assert response["success"]
+
+        return RocketChatMessage.from_message(response["message"])
+
     async def api_get_threaded_messages(
-        self, thread_id: str
+        self, thread_id: str, count: int | None = None, max_messages: int = 50
     ) -> list[RocketChatMessage]:
-        """https://developer.rocket.chat/apidocs/get-thread-messages"""
+        """https://developer.rocket.chat/apidocs/get-thread-messages
+
+        :param count: The number of replies of the thread if it is known, no page is requested after the last reply.
+        """
         url = f"{self.base_url}/api/v1/chat.getThreadMessages"
         params = {"tmid": thread_id}
 
-        return await self.retrieve_all_items(
-            url,
-            params,
-            RocketChatMessage.from_threaded_result,
+        messages: list[RocketChatMessage] = []
+        pages = self.iter_items(
+            url, params, RocketChatMessage.from_threaded_result, max_messages
         )
+        async with aclosing(pages):
+            async for page in pages:
+                messages.extend(page)
+                if count is not None and len(messages) >= count:
+                    break
+        return messages
+
+    async def api_sync_thread_messages(
+        self, thread_id: str, updated_since: str
+    ) -> tuple[list[RocketChatMessage], list[str]]:
+        """https://developer.rocket.chat/apidocs/sync-thread-messages"""
+        url = f"{self.base_url}/api/v1/chat.syncThreadMessages"
+        params = {"tmid": thread_id, "updatedSince": updated_since}
+
+        response = await scheduled_get(self.client, url, params=params)
+        response.raise_for_status()
+        response = response.json()
+        assert response["success"]
 
-    async def retrieve_all_items(
+        messages = response["messages"]
+        return (
+            [RocketChatMessage.from_message(r) for r in messages.get("update", [])],
+            [r["_id"] for r in messages.get("remove", [])],
+        )
+
+    async def iter_items(
         self,
         url: str,
         params: dict,
-        constructor: Callable[[dict], T],
-        max_messages: int = 50,
-    ) -> List[T]:
-        """Helper method that runs API with offset"""
-        params.setdefault("offset", 0)
-        params["count"] = self.step_size
-        all_items: List[T] = []
-
-        i = 0
-
-        while i < max_messages:
-            response = await self.client.get(url=url, params=params)
+        constructor: Callable[[dict], List[T]],
+        max_items: int | None = None,
+    ) -> AsyncIterator[List[T]]:
+        """Yield the items of every page as soon as it arrives, the next page is prefetched while the current one is processed.
+
+        :param max_items: The maximum number of items that are requested and yielded.
+        """
+        offset = params.get("offset", 0)
+        requested = 0
+
+        async def fetch(offset: int, count: int) -> dict:
+            response = await scheduled_get(
+                self.client, url, params={**params, "offset": offset, "count": count}
+            )
             response.raise_for_status()
             response = response.json()
             assert response["success"]
+            return response
+
+        def next_page() -> tuple[asyncio.Task, int] | None:
+            nonlocal offset, requested
+            count = self.step_size
+            if max_items is not None:
+                count = min(count, max_items - requested)
+            if count <= 0:
+                return None
+            page = asyncio.create_task(fetch(offset, count)), count
+            offset += count
+            requested += count
+            return page
+
+        page = next_page()
+        try:
+            while page:
+                task, count = page
+                response = await task
+                # A partial page or a page that reaches the total is the last one
+                page = None
+                if response.get("count", 0) >= count and offset < response.get(
+                    "total", math.inf
+                ):
+                    page = next_page()
+
+                if items := constructor(response)[:count]:
+                    yield items
+        finally:
+            if page:
+                page[0].cancel()
 
-            all_items.extend(constructor(response))
-            params["offset"] += self.step_size
-
-            if response.get("count", 0) < self.step_size:
-                break
-
-            i += self.step_size
+    async def retrieve_all_items(
+        self,
+        url: str,
+        params: dict,
+        constructor: Callable[[dict], List[T]],
+        max_messages: int = 50,
+    ) -> List[T]:
+        """Helper method that collects at most max_messages items of a paginated API"""
+        all_items: List[T] = []
+        async for items in self.iter_items(url, params, constructor, max_messages):
+            all_items.extend(items)
 
         return all_items
@@ -0,0 +1,290 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timezone
+from os import environ
+
+import structlog
+from util.rocket_client import ChatRoom, RocketChatClient, RocketChatMessage
+
+#
+# Incremental synchronization of Rocket.Chat room histories into a local full-text index
+#
+
+log = structlog.get_logger(emitter="rocket_sync")
+
+REGEX_SYMBOLS = re.compile(r"[.^$*+?{}\[\]()|\\]")
+
+_store: "RocketStore | None" = None
+
+
+def required_literal(term: str) -> str | None:
+    """Return the longest literal part of a regex that every match has to contain"""
+    if re.search(r"[|()\[\]\\]", term):
+        return None
+
+    runs, run = [], ""
+    quantifier = False
+    for character in term:
+        if quantifier:
+            # The bounds of {m,n} quantifiers are regex syntax
+            quantifier = character != "}"
+            continue
+        if not REGEX_SYMBOLS.match(character):
+            run += character
+            continue
+        if character in "?*{":
+            # The previous character is optional
+            run = run[:-1]
+        quantifier = character == "{"
+        runs.append(run)
+        run = ""
+    runs.append(run)
+
+    return max(runs, key=len).strip() or None
+
+
+def _regexp(pattern: str, text: str) -> bool:
+    return re.search(pattern, text, re.IGNORECASE) is not None
+
+
+class RocketStore:
+    """SQLite store of synchronized room histories with a trigram full-text index.
+
+    The trigram tokenizer allows substring matches of keywords with at least three
+    characters, the same semantics as the regex search of chat.search. Keywords that
+    contain regex syntax are matched by their literal parts and filtered by the regex.
+    """
+
+    def __init__(self, path: str):
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.create_function("regexp", 2, _regexp, deterministic=True)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT NOT NULL UNIQUE,
+                room_id TEXT NOT NULL,
+                thread_id TEXT,
+                username TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                ts TEXT NOT NULL,
+                msg TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_room ON messages (room_id, ts);
+            CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id, ts);
+            CREATE TABLE IF NOT EXISTS rooms (
+                id TEXT PRIMARY KEY,
+                newest TEXT,
+                synced TEXT NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                msg, content='messages', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, msg) VALUES (new.rowid, new.msg);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, msg) VALUES ('delete', old.rowid, old.msg);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_update AFTER UPDATE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, msg) VALUES ('delete', old.rowid, old.msg);
+                INSERT INTO messages_fts (rowid, msg) VALUES (new.rowid, new.msg);
+            END;
+        """)
+        self.connection.commit()
+
+    def newest(self, room_id: str) -> str | None:
+        """The timestamp of the newest synchronized message of a room"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT newest FROM rooms WHERE id = ?", [room_id]
+            ).fetchone()
+        return row[0] if row else None
+
+    def synced_rooms(self, room_ids: list[str]) -> set[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id FROM rooms WHERE id IN (SELECT value FROM json_each(?))",
+                [json.dumps(room_ids)],
+            )
+            return {r[0] for r in rows}
+
+    def add_messages(self, room_id: str, messages: list[RocketChatMessage]):
+        with self.lock:
+            self.connection.executemany(
+                """INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET msg = excluded.msg""",
+                [
+                    (
+                        m.message_id,
+                        room_id,
+                        m.thread_id,
+                        m.username,
+                        m.user_id,
+                        m.timestamp,
+                        m.message,
+                    )
+                    for m in messages
+                    if m.message
+                ],
+            )
+            self.connection.commit()
+
+    def set_newest(self, room_id: str, newest: str | None):
+        """Mark a room as synchronized up to the newest message"""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO rooms VALUES (?, ?, ?)",
+                [room_id, newest, datetime.now(timezone.utc).isoformat()],
+            )
+            self.connection.commit()
+
+    def search(
+        self, terms: list[str], room_ids: list[str], count: int = 50
+    ) -> dict[str, list[RocketChatMessage]]:
+        """Return the newest count messages of every room that match any of the (regex) terms.
+
+        Terms are matched literally if they are not valid (Python) regular expressions.
+        """
+        pattern = "(" + "|".join(terms) + ")"
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            log.warn(
+                "invalid search pattern, matching literally",
+                pattern=pattern,
+                error=str(e),
+            )
+            terms = [re.escape(t) for t in terms]
+            pattern = "(" + "|".join(terms) + ")"
+        literals = [required_literal(t) for t in terms]
+        # Terms without a literal of at least three characters can not use the trigram index,
+        # every message of the rooms is matched against the regex instead
+        scan = any(not l or len(l) < 3 for l in literals)
+        match = " OR ".join(
+            '"{}"'.format(l.replace('"', '""')) for l in literals if l and len(l) >= 3
+        )
+
+        condition = "msg REGEXP :pattern"
+        if not scan:
+            condition = f"rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH :match) AND {condition}"
+
+        with self.lock:
+            rows = self.connection.execute(
+                f"""SELECT room_id, id, thread_id, username, user_id, ts, msg FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY ts DESC) AS n
+                    FROM messages
+                    WHERE room_id IN (SELECT value FROM json_each(:rooms)) AND {condition}
+                ) WHERE n <= :count ORDER BY room_id, ts DESC""",
+                {
+                    "rooms": json.dumps(room_ids),
+                    "match": match,
+                    "pattern": pattern,
+                    "count": count,
+                },
+            ).fetchall()
+
+        results: dict[str, list[RocketChatMessage]] = {}
+        for room_id, *message in rows:
+            results.setdefault(room_id, []).append(row_to_message(message))
+        return results
+
+    def messages(self, message_ids: list[str]) -> dict[str, RocketChatMessage]:
+        with self.lock:
+            rows = self.connection.execute(
+                """SELECT id, thread_id, username, user_id, ts, msg FROM messages
+                WHERE id IN (SELECT value FROM json_each(?))""",
+                [json.dumps(message_ids)],
+            ).fetchall()
+        return {r[0]: row_to_message(r) for r in rows}
+
+    def threads(self, thread_ids: list[str]) -> dict[str, list[RocketChatMessage]]:
+        """Return the messages of threads, ordered by timestamp"""
+        with self.lock:
+            rows = self.connection.execute(
+                """SELECT thread_id, id, thread_id, username, user_id, ts, msg FROM messages
+                WHERE thread_id IN (SELECT value FROM json_each(?)) ORDER BY ts""",
+                [json.dumps(thread_ids)],
+            ).fetchall()
+
+        threads: dict[str, list[RocketChatMessage]] = {}
+        for thread_id, *message in rows:
+            threads.setdefault(thread_id, []).append(row_to_message(message))
+        return threads
+
+
+def row_to_message(row: list) -> RocketChatMessage:
+    message_id, thread_id, username, user_id, timestamp, message = row
+    return RocketChatMessage(
+        message=message,
+        message_id=message_id,
+        thread_id=thread_id,
+        score=None,
+        username=username,
+        user_id=user_id,
+        timestamp=timestamp,
+    )
+
+
+class RocketSync:
+    """Synchronizes the histories of all rooms of a Rocket.Chat user into a RocketStore.
+
+    Only messages newer than the newest synchronized message of a room are retrieved. Rooms
+    that were never synchronized are backfilled with at most max_messages messages.
+    """
+
+    def __init__(
+        self, client: RocketChatClient, store: RocketStore, max_messages: int = 1000
+    ):
+        self.client = client
+        self.store = store
+        self.max_messages = max_messages
+
+    async def sync_room(self, room: ChatRoom) -> int:
+        oldest = self.store.newest(room.room_id)
+        newest = oldest
+        n = 0
+        # The history is returned newest first, incremental runs retrieve everything to not leave gaps
+        async for messages in self.client.iter_room_history(
+            room, oldest, self.max_messages if oldest is None else sys.maxsize
+        ):
+            self.store.add_messages(room.room_id, messages)
+            newest = max([newest or "", *(m.timestamp for m in messages)]) or None
+            n += len(messages)
+
+        # Only advance the room once its whole history was stored, an interrupted run leaves no gaps
+        self.store.set_newest(room.room_id, newest)
+        return n
+
+    async def sync(self) -> int:
+        """Synchronize all rooms, returns the number of new messages"""
+        rooms = await self.client.retrieve_all_rooms()
+
+        async def sync_room(room: ChatRoom) -> int:
+            async with self.client.semaphore:
+                try:
+                    return await self.sync_room(room)
+                except:
+                    log.exception("could not synchronize room", room_id=room.room_id)
+                    return 0
+
+        n = sum(await asyncio.gather(*[sync_room(r) for r in rooms]))
+        log.info("synchronized", n_rooms=len(rooms), n_messages=n)
+        return n
+
+
+def load_rocket_store() -> RocketStore | None:
+    """Return the store written by rocket_indexer.py if it exists"""
+    global _store
+    path = environ.get("ROCKET_STORE_PATH", "./cache/rocket.sqlite")
+    if _store is None and os.path.exists(path):
+        _store = RocketStore(path)
+    return _store
@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import time
+from email.utils import parsedate_to_datetime
+from os import environ
+from urllib.parse import urlsplit
+
+import structlog
+from httpx import AsyncClient, Response
+
+#
+# Per-host request scheduling: adaptive concurrency (AIMD), token bucket rate limiting and Retry-After handling
+#
+
+log = structlog.get_logger(emitter="scheduler")
+
+
+def retry_after(response: Response) -> float | None:
+    """Parse the Retry-After header (seconds or HTTP date) of a response"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostScheduler:
+    """Schedules the requests to a single host.
+
+    At most `limit` requests are in flight at the same time. The limit grows additively with
+    every successful request up to max_concurrency and is halved (down to min_concurrency)
+    whenever the host answers with 429 or 5xx. Requests are additionally rate limited by a token
+    bucket and throttled requests are retried after the time given by the Retry-After header
+    (at most max_retry_after seconds).
+    """
+
+    def __init__(
+        self,
+        host: str,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        rate: float = 20,
+        burst: int = 20,
+        max_retries: int = 3,
+        max_retry_after: float = 60,
+    ):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+
+        self.condition = asyncio.Condition()
+        self.in_flight = 0
+        self.queued = 0
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.blocked_until = 0.0
+
+        self.requests = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+
+    def take_token(self) -> float:
+        """Take a token if one is available, otherwise return the time until the next one"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        async with self.condition:
+            self.queued += 1
+            try:
+                while True:
+                    await self.condition.wait_for(
+                        lambda: self.in_flight < int(self.limit)
+                    )
+                    # A token is only taken once the request is sent right away
+                    delay = self.blocked_until - time.monotonic()
+                    if delay <= 0:
+                        delay = self.take_token()
+                    if delay <= 0:
+                        break
+                    # Wait outside of the condition, so other requests are not blocked
+                    self.condition.release()
+                    try:
+                        await asyncio.sleep(delay)
+                    finally:
+                        await self.condition.acquire()
+                self.in_flight += 1
+            finally:
+                self.queued -= 1
+
+    async def release(self, throttled: bool):
+        async with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    async def request(
+        self, client: AsyncClient, method: str, url: str, **kwargs
+    ) -> Response:
+        """Send a request once the host has capacity, retrying throttled requests"""
+        for attempt in range(self.max_retries + 1):
+            queued = time.monotonic()
+            await self.acquire()
+            wait = time.monotonic() - queued
+            self.requests += 1
+            self.total_wait += wait
+            if wait > 1:
+                log.info("request queued", host=self.host, wait=wait, **self.stats())
+
+            throttled = False
+            try:
+                response = await client.request(method, url, **kwargs)
+                throttled = response.status_code == 429 or response.status_code >= 500
+            finally:
+                await self.release(throttled)
+
+            if not throttled or attempt == self.max_retries:
+                return response
+
+            self.throttled += 1
+            delay = retry_after(response)
+            if delay is None:
+                delay = 2**attempt
+            delay = min(delay, self.max_retry_after)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            log.warn(
+                "request throttled",
+                host=self.host,
+                status=response.status_code,
+                delay=delay,
+                **self.stats(),
+            )
+
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "mean_wait": self.total_wait / self.requests if self.requests else 0.0,
+        }
+
+
+@functools.cache
+def host_scheduler(host: str) -> HostScheduler:
+    return HostScheduler(
+        host,
+        max_concurrency=int(environ.get("HTTP_MAX_CONCURRENCY", 8)),
+        rate=float(environ.get("HTTP_RATE_LIMIT", 20)),
+        burst=int(environ.get("HTTP_BURST", 20)),
+        max_retry_after=float(environ.get("HTTP_MAX_RETRY_AFTER", 60)),
+    )
+
+
+async def scheduled_get(client: AsyncClient, url: str, **kwargs) -> Response:
+    """GET a URL through the process-wide scheduler of its host"""
+    return await host_scheduler(urlsplit(url).netloc).request(
+        client, "GET", url, **kwargs
+    )
@@ -0,0 +1,48 @@
+import numpy as np
+
+#
+# Vectorized cosine scoring of (chunked) documents against a question embedding
+#
+
+
+def normalize(vectors) -> np.ndarray:
+    """Return vectors as contiguous float32 array with unit length (rows are normalized for matrices)"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def document_distances(
+    question_embedding: np.ndarray,
+    chunk_embeddings: np.ndarray,
+    owners: np.ndarray,
+    n_documents: int,
+) -> np.ndarray:
+    """Return the smallest cosine distance of every document's chunks to the question.
+
+    :param question_embedding: Normalized question embedding of shape (d,)
+    :param chunk_embeddings: Normalized chunk embeddings of shape (n_chunks, d)
+    :param owners: Index of the document each chunk belongs to, shape (n_chunks,)
+    :param n_documents: Number of documents, documents without chunks have an infinite distance
+    """
+    distances = np.full(n_documents, np.inf, dtype=np.float32)
+    if len(chunk_embeddings):
+        chunk_distances = 1.0 - chunk_embeddings @ question_embedding
+        np.minimum.at(distances, owners, chunk_distances)
+    return distances
+
+
+def top_k(
+    question_embedding: np.ndarray,
+    chunk_embeddings: np.ndarray,
+    owners: np.ndarray,
+    n_documents: int,
+    k: int | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the indices and distances of the k closest documents, closest first"""
+    distances = document_distances(
+        question_embedding, chunk_embeddings, owners, n_documents
+    )
+    order = np.argsort(distances, kind="stable")[:k]
+    order = order[np.isfinite(distances[order])]
+    return order, distances[order]
@@ -0,0 +1,87 @@
+import re
+
+#
+# Cheap local check whether a claim is supported by a document, based on n-gram overlap
+#
+
+SENTENCE = re.compile(r"(?<=[.!?])\s+|\n+")
+TOKEN = re.compile(r"\w+")
+# Markdown list markers, headings and quotes at the start of a line
+MARKUP = re.compile(r"^\s*(?:[-*+>#]+|\d+[.)])\s*")
+# Numerical citations like [1], [1, 2] or [^3]
+CITATION = re.compile(r"\s*\[\^?\d+(?:\s*[,-]\s*\d+)*\]")
+LINK = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+URL = re.compile(r"<?https?://\S+")
+HEADING = re.compile(r"^\s*(?:#+|\*\*)")
+# Headings of the reference section, it may be translated into the language of the question
+REFERENCES = re.compile(
+    r"^\s*(?:#+\s*|\*\*)?(?:references|referenzen|quellen|sources)\b", re.IGNORECASE
+)
+
+
+def strip_references(text: str) -> str:
+    """Remove the reference section, lines that only contain links and citation markers"""
+    lines = []
+    in_references = False
+    for line in text.splitlines():
+        if HEADING.match(line) or REFERENCES.match(line):
+            in_references = REFERENCES.match(line) is not None
+        if in_references:
+            continue
+        # Lines that only consist of links (and list markers)
+        if not tokens(MARKUP.sub("", LINK.sub("", URL.sub("", line)))) and line.strip():
+            continue
+        lines.append(line)
+
+    text = CITATION.sub("", "\n".join(lines))
+    return URL.sub("", LINK.sub(r"\1", text))
+
+
+def split_claims(text: str, min_words: int = 4) -> list[str]:
+    """Split a (markdown) answer into sentences that state something.
+
+    References, links and citation markers are removed, short lines like headings are skipped.
+    """
+    sentences = (
+        MARKUP.sub("", s).strip() for s in SENTENCE.split(strip_references(text))
+    )
+    return [s for s in sentences if len(tokens(s)) >= min_words]
+
+
+def tokens(text: str) -> list[str]:
+    return TOKEN.findall(text.lower())
+
+
+def bigrams(words: list[str]) -> set[tuple[str, str]]:
+    return set(zip(words, words[1:]))
+
+
+def support_score(document: str, claim: str) -> float:
+    """Return the support of the least supported sentence of a claim.
+
+    The support of a sentence is the fraction of its bigrams (words for single word sentences)
+    that are contained in the document. Sentences with numbers that are not contained in the
+    document are not supported.
+    """
+    document_words = tokens(document)
+    document_unigrams = set(document_words)
+    document_bigrams = bigrams(document_words)
+
+    scores = []
+    for sentence in SENTENCE.split(claim):
+        words = tokens(sentence)
+        if not words:
+            continue
+        if any(
+            w not in document_unigrams for w in words if any(c.isdigit() for c in w)
+        ):
+            scores.append(0.0)
+        elif len(words) == 1:
+            scores.append(float(words[0] in document_unigrams))
+        else:
+            sentence_bigrams = bigrams(words)
+            scores.append(
+                len(sentence_bigrams & document_bigrams) / len(sentence_bigrams)
+            )
+
+    return min(scores, default=1.0)
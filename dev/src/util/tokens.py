@@ -0,0 +1,124 @@
+import functools
+import importlib.util
+import math
+from os import environ
+
+import structlog
+from jinja2 import Template
+
+#
+# Token accounting: estimates prompt sizes and packs content into per-template input budgets
+#
+
+log = structlog.get_logger(emitter="tokens")
+
+# Number of truncated prompts per template
+truncations: dict[str, int] = {}
+
+
+@functools.cache
+def _encoding():
+    # Counting with a tokenizer requires the optional tiktoken package
+    if importlib.util.find_spec("tiktoken") is None:
+        log.info("tiktoken is not installed, estimating tokens by characters")
+        return None
+
+    import tiktoken
+
+    return tiktoken.get_encoding(environ.get("TOKENIZER_ENCODING", "cl100k_base"))
+
+
+def characters_per_token() -> float:
+    return float(environ.get("CHARACTERS_PER_TOKEN", 3))
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text using tiktoken or estimate them using CHARACTERS_PER_TOKEN"""
+    if encoding := _encoding():
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / characters_per_token())
+
+
+@functools.cache
+def _budgets() -> dict[str, int]:
+    entries = [e.split("=") for e in environ.get("TOKEN_BUDGETS", "").split(",")]
+    return {e[0].strip(): int(e[1]) for e in entries if len(e) == 2}
+
+
+def token_budget(template_name: str) -> int | None:
+    """The input budget of a template, None if neither TOKEN_BUDGETS nor MODEL_CONTEXT_TOKENS is configured.
+
+    Without an entry in TOKEN_BUDGETS the budget is the model's context without its output tokens.
+    """
+    if budget := _budgets().get(template_name):
+        return budget
+    if context := environ.get("MODEL_CONTEXT_TOKENS"):
+        return int(context) - int(environ.get("MODEL_MAX_TOKENS", 1500))
+    return None
+
+
+def remaining_budget(template: Template, variables: dict) -> int | None:
+    """The tokens left for content after rendering a template with variables, None without a budget"""
+    if (budget := token_budget(template.name)) is None:
+        return None
+    return budget - count_tokens(template.render(variables))
+
+
+def record_truncation(
+    template_name: str, tokens: int, budget: int, n: int, n_packed: int
+):
+    truncations[template_name] = truncations.get(template_name, 0) + 1
+    log.warn(
+        "truncated prompt content",
+        template=template_name,
+        tokens=tokens,
+        budget=budget,
+        n=n,
+        n_packed=n_packed,
+        truncations=truncations[template_name],
+    )
+
+
+def truncate(text: str, budget: int, template_name: str) -> str:
+    """Cut a text to at most budget tokens"""
+    tokens = count_tokens(text)
+    if tokens <= budget:
+        return text
+
+    budget = max(0, budget)
+    if encoding := _encoding():
+        truncated = encoding.decode(
+            encoding.encode(text, disallowed_special=())[:budget]
+        )
+    else:
+        truncated = text[: int(budget * characters_per_token())]
+    record_truncation(template_name, tokens, budget, 1, 1)
+
+    return truncated
+
+
+def pack(
+    costs: list[int],
+    budget: int,
+    template_name: str,
+    scores: list[float] | None = None,
+) -> list[int]:
+    """Select the highest scoring items whose costs (in tokens) fit into the budget.
+
+    Items are considered in the order of their scores (or their order without scores), items
+    that do not fit are skipped. Returns the indices of the selected items in their original order.
+    """
+    order = range(len(costs))
+    if scores is not None:
+        order = sorted(order, key=lambda i: -scores[i])
+
+    selected: list[int] = []
+    used = 0
+    for i in order:
+        if used + costs[i] <= budget:
+            selected.append(i)
+            used += costs[i]
+
+    if len(selected) < len(costs):
+        record_truncation(template_name, sum(costs), budget, len(costs), len(selected))
+    return sorted(selected)